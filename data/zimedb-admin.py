@@ -30,7 +30,8 @@ usage = '''
 %prog [options] --install   Schema.txt
 %prog [options] --uninstall <Schema>
 %prog [options] --save      <Schema>
-%prog [options] --restore   <Schema>'''
+%prog [options] --restore   <Schema>
+%prog [options] --compile   <Schema>'''
 parser = optparse.OptionParser(usage)
 
 parser.add_option('-l', '--list', action='store_true', dest='list_schema', default=False, help='command: show schema list')
@@ -38,8 +39,10 @@ parser.add_option('-i', '--install', dest='install_schema', help='command: insta
 parser.add_option('-u', '--uninstall', dest='uninstall_schema', help='command: uninstall schema and associated dict', metavar='Schema')
 parser.add_option('-s', '--save', dest='save_userdata', help='command: save user data', metavar='Schema')
 parser.add_option('-r', '--restore', dest='restore_userdata', help='command: restore user data', metavar='Schema')
+parser.add_option('--compile', dest='compile_dict', help='command: compile dict into a memory-mapped binary file', metavar='Schema')
 parser.add_option('-c', '--compact', action='store_true', dest='compact', default=False, help='compact db file on modifications')
 parser.add_option('-d', '--db-file', dest='db_file', help='specify zimedb location', metavar='FILE')
+parser.add_option('-y', '--system-db-file', dest='system_db_file', help='specify system dict location; --db-file then holds user data only', metavar='FILE')
 parser.add_option('-k', '--keep', action='store_true', dest='keep', default=False, help='keep existing dict while installing schema')
 parser.add_option('-n', '--no-phrases', action='store_true', dest='no_phrases', default=False, help='do not use phrase file while installing schema')
 parser.add_option('-p', '--prefix', dest='source_prefix', help='specify the prefix for dict files', metavar='PREFIX')
@@ -51,15 +54,25 @@ options, args = parser.parse_args()
 if len(args) != 0:
     parser.error('incorrect number of arguments')
 
+system_db_file = options.system_db_file
 if not options.db_file:
     home_path = os.path.expanduser('~')
     db_path = os.path.join(home_path, '.ibus', 'zime')
     if not os.path.isdir(db_path):
         os.makedirs(db_path)
     db_file = os.path.join(db_path, 'zime.db')
+    if not system_db_file and os.path.exists(os.path.join(db_path, 'zime-sys.db')):
+        system_db_file = os.path.join(db_path, 'zime-sys.db')
 else:
     db_file = options.db_file
 
+# 安裝、卸載只寫系統詞典；備份、恢復用戶數據時附加系統詞典
+user_data_commands = options.save_userdata or options.restore_userdata
+writing_system_db = system_db_file and not user_data_commands
+if writing_system_db:
+    db_file = system_db_file
+    system_db_file = None
+
 if not os.path.exists(db_file):
     if options.install_schema:
         print >> sys.stderr, 'creating new db file: %s' % db_file
@@ -67,7 +80,11 @@ if not os.path.exists(db_file):
         print >> sys.stderr, 'cannot locate db file: %s' % db_file
         exit(-1)
 
-DB.open(db_file)
+if system_db_file and not os.path.exists(system_db_file):
+    print >> sys.stderr, 'cannot locate system db file: %s' % system_db_file
+    exit(-1)
+
+DB.open(db_file, system_db_file=system_db_file)
 
 
 # retrieve schema list and associated dict names
@@ -183,6 +200,9 @@ def install_schema(schema_file):
 
     if options.keep:
         DB.flush(True)
+        save_spelling_algebra(DB(schema), schema)
+        if writing_system_db:
+            DB.seal()
         print >> sys.stderr, 'done.'
         exit()
 
@@ -253,12 +273,38 @@ def install_schema(schema_file):
         db.add_phrases(batch, indexer)
     print >> sys.stderr, 'totaling %d phrases imported.' % counter
 
+    # 已編譯過的詞典隨之更新
+    if os.path.exists(DB.compiled_dict_path(dict_prefix)):
+        print >> sys.stderr, 'compiled dict updated: %s' % db.compile()
+
     if options.compact:
         DB.compact()
     DB.flush(True)
+    save_spelling_algebra(db, schema)
+    if writing_system_db:
+        DB.seal()
     print >> sys.stderr, 'done.'
 
 
+def save_spelling_algebra(db, schema):
+    '''按已安裝的設定值和音節表做拼寫運算，結果存檔供輸入法直接載入'''
+    get_rules = lambda f, key: [f(r.split()) for r in db.read_config_list(key)]
+    compile_repl_pattern = lambda x: (re.compile(x[0]), x[1])
+    mapping_rules = get_rules(compile_repl_pattern, u'MappingRule')
+    fuzzy_rules = get_rules(compile_repl_pattern, u'FuzzyRule')
+    spelling_rules = get_rules(compile_repl_pattern, u'SpellingRule')
+    alternative_rules = get_rules(compile_repl_pattern, u'AlternativeRule')
+    keywords = db.list_keywords()
+    sa = SpellingAlgebra(report_errors=False)
+    sa.calculate_cached(DB.algebra_path(schema),
+                        mapping_rules, 
+                        fuzzy_rules, 
+                        spelling_rules, 
+                        alternative_rules, 
+                        keywords)
+    return sa
+
+
 def uninstall_schema(schema):
 
     if schema not in schemas:
@@ -280,10 +326,15 @@ def uninstall_schema(schema):
         if no_longer_needed:
             print >> sys.stderr, u'dict %s associated with %s is no longer needed; dropped...' % (prefix, schema)
             DB(schema).drop_tables()
+    algebra_file = DB.algebra_path(schema)
+    if os.path.exists(algebra_file):
+        os.remove(algebra_file)
 
     if options.compact:
         DB.compact()
     DB.flush(True)
+    if writing_system_db:
+        DB.seal()
     print >> sys.stderr, u'schema %s has been removed.' % schema
 
 
@@ -325,19 +376,7 @@ def restore_userdata(schema):
     filename_prefix = prefix.replace(u'_', u'-')
 
     max_key_length = int(db.read_config_value(u'MaxKeyLength') or u'2')
-    get_rules = lambda f, key: [f(r.split()) for r in db.read_config_list(key)]
-    compile_repl_pattern = lambda x: (re.compile(x[0]), x[1])
-    mapping_rules = get_rules(compile_repl_pattern, u'MappingRule')
-    fuzzy_rules = get_rules(compile_repl_pattern, u'FuzzyRule')
-    spelling_rules = get_rules(compile_repl_pattern, u'SpellingRule')
-    alternative_rules = get_rules(compile_repl_pattern, u'AlternativeRule')
-    keywords = db.list_keywords()
-    sa = SpellingAlgebra(report_errors=False)
-    sa.calculate(mapping_rules, 
-                 fuzzy_rules, 
-                 spelling_rules, 
-                 alternative_rules, 
-                 keywords)
+    sa = save_spelling_algebra(db, schema)
     def g(ikeys, okey, depth):
         if not okey or depth >= max_key_length:
             return ikeys
@@ -372,7 +411,12 @@ def restore_userdata(schema):
         print >> sys.stderr, 'checking new phrases...'
     def reporter(phrase, okey):
         print >> sys.stderr, 'INFO: introducing new phrase %s %s' % (phrase, okey)
-    db.add_phrases([(k, 0) for (k, ufreq) in userfreq_table], indexer, reporter=reporter)
+    if system_db_file:
+        # 系統詞典只讀；其中沒有的詞條不予恢復
+        if options.verbose:
+            print >> sys.stderr, 'skipped: phrases missing from system dict will not be restored.'
+    else:
+        db.add_phrases([(k, 0) for (k, ufreq) in userfreq_table], indexer, reporter=reporter)
     if options.verbose:
         print >> sys.stderr, 'adjusting user freq...'
     db.restore_user_freq(userfreq_table)
@@ -401,12 +445,27 @@ def restore_userdata(schema):
     db.restore_user_gram(usergram_table, indexer)
     print >> sys.stderr, '%d records restored from %s' % (len(usergram_table), usergram_file)
 
+    # 恢復時可能新增了詞條，已編譯過的詞典隨之更新
+    if not system_db_file and os.path.exists(DB.compiled_dict_path(prefix)):
+        print >> sys.stderr, 'compiled dict updated: %s' % db.compile()
+
     if options.compact:
         DB.compact()
     DB.flush(True)
     print >> sys.stderr, 'done.'
 
 
+def compile_dict(schema):
+
+    if schema not in schemas:
+        print >> sys.stderr, u'non-existing schema: %s' % schema
+        return
+
+    db = DB(schema)
+    path = db.compile()
+    print >> sys.stderr, 'compiled dict saved to %s' % path
+
+
 if options.install_schema:
     install_schema(options.install_schema)
 elif options.uninstall_schema:
@@ -415,5 +474,7 @@ elif options.save_userdata:
     save_userdata(options.save_userdata)
 elif options.restore_userdata:
     restore_userdata(options.restore_userdata)
+elif options.compile_dict:
+    compile_dict(options.compile_dict)
 else:
     list_schema()
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 # vim:set et sts=4 sw=4:
 
+import hashlib
+import marshal
+import os
+
 
 class SpellingCollisionError:
 
@@ -24,9 +28,59 @@ class SpellingAlgebra:
 
     '''
 
+    # 運算結果緩存文件的格式版本
+    CACHE_VERSION = 1
+
     def __init__(self, report_errors=True):
         self.__report_errors = report_errors
 
+    @staticmethod
+    def digest(mapping_rules, fuzzy_rules, spelling_rules, alternative_rules, keywords):
+        '''規則及音節表的摘要；二者不變，運算結果亦不變'''
+        h = hashlib.sha1()
+        for rules in (mapping_rules, fuzzy_rules, spelling_rules, alternative_rules):
+            for r in rules:
+                h.update((u'%s\t%s\n' % (r[0].pattern, r[1])).encode('utf-8'))
+            h.update('\f')
+        for k in keywords:
+            h.update((u'%s\n' % k).encode('utf-8'))
+        return h.hexdigest()
+
+    def load(self, path, digest):
+        '''自緩存文件載入運算結果，摘要不符時返回False'''
+        try:
+            with open(path, 'rb') as f:
+                r = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if not isinstance(r, tuple) or len(r) != 5 or r[:2] != (SpellingAlgebra.CACHE_VERSION, digest):
+            return False
+        self.spelling_map, self.io_map, self.oi_map = r[2:]
+        return True
+
+    def save(self, path, digest):
+        '''將運算結果寫入緩存文件'''
+        data = marshal.dumps((SpellingAlgebra.CACHE_VERSION, digest, self.spelling_map, self.io_map, self.oi_map))
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+
+    def calculate_cached(self, path, mapping_rules, fuzzy_rules, spelling_rules, alternative_rules, keywords):
+        '''同calculate；結果緩存於path，規則及音節表不變時直接載入'''
+        args = (mapping_rules, fuzzy_rules, spelling_rules, alternative_rules, keywords)
+        digest = SpellingAlgebra.digest(*args)
+        if path and self.load(path, digest):
+            return
+        self.calculate(*args)
+        if path:
+            try:
+                self.save(path, digest)
+            except (IOError, OSError):
+                pass
+
     def calculate(self, mapping_rules, fuzzy_rules, spelling_rules, alternative_rules, keywords):
 
         akas = dict()
@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 # vim:set et sts=4 sw=4:
 
+import heapq
 import re
+import sys
+import threading
 from math import log
 
 from algebra import *
-from segmentation import Segmentor
+from profiler import Profiler
+from segmentation import Segmentor, SegmentationInfo
 
 
-class Entry:
+class Entry(object):
 
-    # TODO: 用slots做性能優化
+    __slots__ = ('e', 'i', 'j', 'prob', 'use_count', 'next')
 
     def __init__(self, e, i, j, prob=0.0, use_count=0, next=None):
         self.e = e
@@ -37,13 +41,24 @@ class Entry:
             s = s.next
         return w
 
+    def get_last(self):
+        s = self
+        while s.next:
+            s = s.next
+        return s
+
     def get_phrase(self):
         ''' 取詞組
 
         ZIME3.x裡，一個候選詞組可由多個詞組成，有bigram將他們連接起來
         今後，這樣的詞組不再作為候選列出
         '''
-        return u''.join([e.get_word() for e in self.get_all()])
+        w = u''
+        s = self
+        while s:
+            w += s.get_word()
+            s = s.next
+        return w
 
     def partof(self, other):
         ''' 判斷另一個詞／詞組是不是本詞組的一個前綴
@@ -64,6 +79,74 @@ class Entry:
             (self.get_word(), self.prob, self.use_count, self.i, self.j, (u' => %s' % self.next.get_phrase()) if self.next else u'')
 
 
+class CandidateList(object):
+
+    '''按需生成的候選列表
+
+    候選按詞長分組，長詞在前；組內按使用次數與概率排序，略去字面相同的詞組
+    各組到取用時才建堆逐個彈出，前端只取當前頁，翻頁時再往後生成
+
+    '''
+
+    def __init__(self, groups):
+        self.__groups = [s for s in groups if s]
+        self.__heap = []
+        self.__phrases = None
+        self.__items = []
+        self.__count = None
+
+    def fetch(self, n):
+        '''生成至共有n個候選或已無更多為止，返回已生成的個數'''
+        items = self.__items
+        while len(items) < n:
+            if not self.__heap:
+                if not self.__groups:
+                    break
+                # 以原有次序為第二鍵，同分者保持原有次序
+                s = self.__groups.pop(0)
+                self.__heap = [(-(e.use_count + e.prob), k, e) for k, e in enumerate(s)]
+                heapq.heapify(self.__heap)
+                self.__phrases = set()
+            e = heapq.heappop(self.__heap)[2]
+            p = e.get_phrase()
+            # ignore less freqently used phrases with identical representation
+            if p not in self.__phrases:
+                self.__phrases.add(p)
+                items.append((p, e))
+        return len(items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            stop = index.stop
+            if stop is None or stop < 0 or (index.start or 0) < 0:
+                self.fetch(sys.maxint)
+            else:
+                self.fetch(stop)
+        else:
+            self.fetch(index + 1 if index >= 0 else sys.maxint)
+        return self.__items[index]
+
+    def __iter__(self):
+        k = 0
+        while k < self.fetch(k + 1):
+            yield self.__items[k]
+            k += 1
+
+    def __len__(self):
+        '''候選總數；只按組數出字面不同的詞組，不必排序生成全部候選'''
+        if self.__count is None:
+            n = len(self.__items)
+            if self.__heap:
+                n += len(set([x[2].get_phrase() for x in self.__heap]) - self.__phrases)
+            for s in self.__groups:
+                n += len(set([e.get_phrase() for e in s]))
+            self.__count = n
+        return self.__count
+
+    def __nonzero__(self):
+        return self.fetch(1) > 0
+
+
 class ContextInfo:
 
     # TODO: 這裡頭的一部分信息應該放到Context裡頭，另一些打包成Context.lmdata
@@ -72,11 +155,16 @@ class ContextInfo:
         self.m = 0
         self.n = 0
         self.e = []
+        self.seg = SegmentationInfo()
         self.q = {}
         self.unig = {}
         self.big = {}
+        # 自上次計算以來新增了後續詞的二元關係，以前詞的eid記錄
+        self.big_added = set()
         self.cand = []
         self.pred = [None]
+        self.concat = []
+        self.sentences = None
         self.last = None
 
 
@@ -88,8 +176,27 @@ class Model:
     LIMIT = 50
     MAX_CONCAT_PHRASE = 3
 
+    # 按方案共用的Model實例；Model本身只讀，各會話的轉換狀態保存在ContextInfo中
+    __models = dict()
+    __lock = threading.Lock()
+
+    @classmethod
+    def for_schema(cls, schema):
+        '''取得方案對應的Model，設定值或詞典有變化時重新建立'''
+        signature = schema.get_db().get_signature()
+        with cls.__lock:
+            r = cls.__models.get(schema.schema_id)
+            if r and r[0] == signature:
+                return r[1]
+            model = cls(schema)
+            cls.__models[schema.schema_id] = (signature, model)
+            return model
+
     def __init__(self, schema):
         self.__max_key_length = int(schema.get_config_value(u'MaxKeyLength') or u'2')
+        # 束寬：每個位置只保留前若干條詞組與整句；0 為不限
+        self.__beam_width = int(schema.get_config_value(u'BeamWidth') or u'0')
+        self.__max_lattice_edges = int(schema.get_config_value(u'MaxLatticeEdges') or u'0')
         get_rules = lambda f, key: [f(r.split()) for r in schema.get_config_list(key)]
         compile_repl_pattern = lambda x: (re.compile(x[0]), x[1])
         mapping_rules = get_rules(compile_repl_pattern, u'MappingRule')
@@ -98,19 +205,23 @@ class Model:
         alternative_rules = get_rules(compile_repl_pattern, u'AlternativeRule')
         keywords = schema.get_db().list_keywords()
         self.__sa = SpellingAlgebra(report_errors=False)
-        self.__sa.calculate(mapping_rules, 
-                            fuzzy_rules, 
-                            spelling_rules, 
-                            alternative_rules, 
-                            keywords)
+        self.__sa.calculate_cached(schema.get_db().algebra_path(schema.schema_id),
+                                   mapping_rules, 
+                                   fuzzy_rules, 
+                                   spelling_rules, 
+                                   alternative_rules, 
+                                   keywords)
         self.__segmentor = Segmentor(schema, self.__sa)
-        self.__db = schema.get_db()
 
     def create_context_info(self):
         return ContextInfo()
 
-    def query(self, ctx):
-        m, n, b, d, e = self.__segmentor.segmentation(ctx.input)
+    def query(self, ctx, input=None):
+        '''查詢輸入串；異步查詢時由input傳入輸入串的副本'''
+        if input is None:
+            input = ctx.input
+        with Profiler.phase('segmentation'):
+            m, n, b, d, e = self.__segmentor.segmentation(input, ctx.info.seg)
         prev_e = ctx.info.e
         ctx.info.m = m
         ctx.info.n = n
@@ -128,39 +239,65 @@ class Model:
             i -= 1
         del ctx.sel[i:]
         ctx.confirmed = i
-        self.__lookup_candidates(ctx.info, diff)
-        self.__calculate_sentence(ctx.info)
+        with Profiler.phase('lookup', split_sql=True):
+            self.__lookup_candidates(ctx.schema.get_db(), ctx.info, diff)
+        with Profiler.phase('sentence'):
+            self.__calculate_sentence(ctx.info, diff)
 
-    def __lookup_candidates(self, info, diff):
+    def __lookup_candidates(self, db, info, diff):
         m = info.m
         b = info.b
         e = info.e
         c = info.cand
         unig = info.unig
         big = info.big
-        total, utotal = [x + 0.1 for x in self.__db.lookup_freq_total()]
+        total, utotal = [x + 0.1 for x in db.lookup_freq_total()]
         to_prob = lambda x: log((x + 0.1) / total)
         def make_keys(i, k, length):
             if length == 0 or i == m:    
                 return [(i, k)]
             keys = sum([make_keys(jw, k + [kw], length - 1) for jw, kw in e[i]], [])
             return [(i, k)] + keys
+        def add_unigram(key, result):
+            info.q[key] = result
+            for x in result:
+                prob = to_prob(x[3])
+                unig[x[2]] = prob
+        def add_bigram(result):
+            for x in result:
+                if x[0] in big:
+                    s = big[x[0]]
+                else:
+                    s = big[x[0]] = {}
+                if x[1] not in s:
+                    info.big_added.add(x[0])
+                s[x[1]] = to_prob(x[2])
         def lookup(k):
             key = u' '.join(k)
             if key in info.q:
                 return info.q[key]
-            result = info.q[key] = self.__db.lookup_unigram(key)
-            for x in result:
-                prob = to_prob(x[3])
-                unig[x[2]] = prob
+            add_unigram(key, db.lookup_unigram(key))
             if len(k) >= min(2, self.__max_key_length):
-                for x in self.__db.lookup_bigram(key):
-                    if x[0] in big:
-                        s = big[x[0]]
-                    else:
-                        s = big[x[0]] = {}
-                    s[x[1]] = to_prob(x[2])
-            return result
+                add_bigram(db.lookup_bigram(key))
+            return info.q[key]
+        def prefetch(ks):
+            '''一次取回一組編碼的查詢結果'''
+            keys = set()
+            bigram_keys = set()
+            for k in ks:
+                key = u' '.join(k)
+                if key in info.q:
+                    continue
+                keys.add(key)
+                if len(k) >= min(2, self.__max_key_length):
+                    bigram_keys.add(key)
+            if not keys:
+                return
+            for key, result in db.lookup_unigram_many(keys).iteritems():
+                add_unigram(key, result)
+            if bigram_keys:
+                for result in db.lookup_bigram_many(bigram_keys).itervalues():
+                    add_bigram(result)
         def add_word(x, i, j):
             ##print 'add_word:', i, j, x[0], x[1]
             use_count = x[4]
@@ -197,7 +334,7 @@ class Model:
             #print u'last: %s' % last
             c[-1][0] = [Entry(last.e, -1, 0, last.prob, last.use_count, None)]
             if not info.q:
-                r = self.__db.lookup_bigram_by_entry(last)
+                r = db.lookup_bigram_by_entry(last)
                 if r:
                     eid = last.get_eid()
                     if eid in big:
@@ -207,16 +344,29 @@ class Model:
                     for x in r:
                         s[x[0]] = to_prob(x[1])
         # traverse
+        queries = []
         for i in b:
             for jw, kw in e[i]:
                 for j, k in make_keys(jw, [kw], self.__max_key_length - 1):
                     if j <= diff and len(k) < self.__max_key_length:
                         continue
-                    #print 'lookup:', i, j, k
-                    for x in lookup(k):
-                        judge(x, i, j)
-
-    def __calculate_sentence(self, info):
+                    queries.append((i, j, k))
+        prefetch([k for i, j, k in queries])
+        for i, j, k in queries:
+            #print 'lookup:', i, j, k
+            for x in lookup(k):
+                judge(x, i, j)
+        # rank new candidates by unigram probability and drop the excess
+        if self.__beam_width or self.__max_lattice_edges:
+            rank = lambda x: -unig[x.get_eid()]
+            for i in range(m):
+                for j in range(max(i, diff) + 1, m + 1):
+                    if c[i][j]:
+                        c[i][j].sort(key=rank)
+                        if self.__max_lattice_edges:
+                            del c[i][j][self.__max_lattice_edges:]
+
+    def __calculate_sentence(self, info, diff):
         m = info.m
         b = info.b
         c = info.cand
@@ -227,16 +377,27 @@ class Model:
         # index m should be left empty; index -1 is reserved for the last committed word
         pred = [None for i in range(m + 1 + 1)]
         info.pred = pred
-        def update_pred(i, e):
-            # 用戶用過的詞優先於未用過而但概率高的詞
-            used = lambda x: bool(x.use_count) and x.get_all()[-1].j == m
-            pred_cmp = lambda a, b: cmp(used(a), used(b)) or cmp(a.prob, b.prob)
-            if not pred[i] or pred_cmp(e, pred[i]) > 0:
-                pred[i] = e
-        def succ_phrases(j):
-            '''returns succeeding phrases starting with position j, grouped by eid'''
-            succ = dict()
-            for k in range(j + 1, m + 1):
+        # h[i][j] 與 c[i][j] 一一對應，記錄由各詞條接續而成的詞組 (k, e)
+        # 其中結束於 diff 之前的詞組不受本次編輯影響，可留待下次沿用
+        # 但新增了二元關係的詞須重新接續；概率隨時按當前的二元、一元關係計算
+        h = info.concat
+        added = info.big_added
+        info.big_added = set()
+        for i in range(diff):
+            h[i][diff + 1:] = [None for j in range(diff + 1, m + 1)]
+        h[diff:] = [[None for j in range(m + 1)] for i in range(diff, m + 1)]
+        succ_cache = dict()
+        def succ_phrases(j, full):
+            '''returns succeeding phrases starting with position j, grouped by eid
+
+            只列出結束於 diff 之後的詞組；此前的接續結果已在 h 中保存
+            最近提交的詞 (-1, 0) 每次重建，故 j == 0 時列出全部；full 亦列出全部
+            '''
+            start = j if full or not j else max(j, diff)
+            if (j, start) in succ_cache:
+                return succ_cache[j, start]
+            succ = succ_cache[j, start] = dict()
+            for k in range(start + 1, m + 1):
                 if c[j][k]:
                     for x in c[j][k][:Model.LIMIT]:
                         eid = x.get_eid()
@@ -252,52 +413,100 @@ class Model:
                         else:
                             succ[eid] = [x]
             return succ
+        def make_phrases(x, i, j, r, full=False):
+            '''以二元關係接續 x 與其後的詞，將 (k, e) 追加到 r'''
+            eid = x.get_eid()
+            succ = succ_phrases(j, full)
+            for v in big[eid]:
+                if v in succ:
+                    for y in succ[v]:
+                        e = Entry(x.e, i, j, 0.0, min(x.use_count, y.use_count), y)
+                        r.append((e.get_last().j, e))
+            return r
         # traverse
-        for j in reversed(b):
-            succ = None
-            for i in range(-1, j):
-                if c[i][j]:
+        # 自後向前逐個起點計算；同一起點內的次序與逐個終點遍歷時一致
+        ends = list(reversed(b))
+        penalty = Model.PENALTY
+        beam = self.__beam_width
+        for i in range(m - 1, -2, -1):
+            best = None
+            best_used = False
+            hi = h[i]
+            for j in ends:
+                if j <= i:
+                    break
+                if not c[i][j]:
+                    continue
+                if j == m:
                     for x in c[i][j]:
                         # calculate prob
                         if i != -1:
                             x.prob = unig[x.get_eid()]
-                        if j != m:
-                            x.prob += pred[j].prob + Model.PENALTY
-                        update_pred(i, x)
-                        if j == m:
-                            continue
-                        # try making phrases
-                        eid = x.get_eid()
-                        if eid in big:
-                            if succ is None:
-                                succ = succ_phrases(j)
-                            for v in big[eid]:
-                                if v in succ:
-                                    for y in succ[v]:
-                                        prob = big[eid][v] - unig[v] + y.prob
-                                        e = Entry(x.e, i, j, prob, min(x.use_count, y.use_count), y)
-                                        #print "concat'd phrase:", unicode(e)
-                                        # save phrase
-                                        k = e.get_all()[-1].j
-                                        if f[i][k]:
-                                            f[i][k].append(e)
-                                        else:
-                                            f[i][k] = [e]
-                                        # update pred[i] with concat'd phrases
-                                        update_pred(i, e)
+                        # 用戶用過的詞優先於未用過而但概率高的詞
+                        used = bool(x.use_count)
+                        if not best or used > best_used or used == best_used and x.prob > best.prob:
+                            best, best_used = x, used
+                    continue
+                tail = pred[j].prob + penalty
+                reuse = i != -1 and j <= diff and hi[j] is not None
+                if reuse:
+                    phrases = hi[j]
+                else:
+                    phrases = hi[j] = [None for x in c[i][j]]
+                for n, x in enumerate(c[i][j]):
+                    eid = x.get_eid()
+                    # calculate prob
+                    if i != -1:
+                        x.prob = unig[eid]
+                    x.prob += tail
+                    if not best or not best_used and x.prob > best.prob:
+                        best, best_used = x, False
+                    # try making phrases
+                    full = not reuse or eid in added
+                    r = [] if full else phrases[n]
+                    if r:
+                        r = phrases[n] = [t for t in r if t[0] <= diff]
+                    if eid in big and (not beam or n < beam):
+                        r = phrases[n] = make_phrases(x, i, j, r or [], full)
+                    if not r:
+                        continue
+                    bx = big[eid]
+                    for k, e in r:
+                        v = e.next.get_eid()
+                        e.prob = bx[v] - unig[v] + e.next.prob
+                        # save phrase
+                        if f[i][k]:
+                            f[i][k].append(e)
+                        else:
+                            f[i][k] = [e]
+                        # update pred[i] with concat'd phrases
+                        used = bool(e.use_count) and k == m
+                        if not best or used > best_used or used == best_used and e.prob > best.prob:
+                            best, best_used = e, used
+            if beam:
+                # 同一終點的詞組僅相差自身部分的概率，保留前 beam 條
+                for k in range(i + 1, m + 1):
+                    if f[i][k] and len(f[i][k]) > beam:
+                        f[i][k].sort(key=lambda e: -e.prob)
+                        del f[i][k][beam:]
+            pred[i] = best
+        info.sentences = self.__make_sentences(info, beam) if beam else None
         # make sentences
+        # 處理過的 pred[k] 已是直達句末的整句副本，或是結束於 m 的單個詞條
+        # 故只須複製 pred[i] 自身的節點，句子其後的部分與 pred[k] 共用
         for i in range(m - 1, -1, -1):
             if pred[i]:
-                k = i
-                s = []
-                while k < m:
-                  x = pred[k]
-                  a = x.get_all()
-                  k = a[-1].j
-                  s.extend(a)
+                s = pred[i].get_all()
+                k = s[-1].j
+                rest = None
+                if k < m:
+                    x = pred[k]
+                    s.append(x)
+                    rest = x.next
+                    k = m
                 if len(s) > 1:
                     # copy nodes
-                    head = None
+                    head = rest
                     for y in reversed(s):
                         head = Entry(y.e, y.i, y.j, y.prob, 0, head)
                     if f[i][k]:
@@ -314,6 +523,57 @@ class Model:
                 print unicode(x)
         """
 
+    def __make_sentences(self, info, beam):
+        '''求出自各位置至句末的前 beam 條整句
+
+        top[i] 中每項為 (prob, e, k, n)：以 e 起始、結束於 k，其後接 top[k][n]
+        各詞條的 prob 已含其後最佳路徑的概率，故只須在每個位置取 prob 最高的
+        beam 個詞條，與其後位置的前 beam 條路徑組合
+        '''
+        m = info.m
+        b = info.b
+        c = info.cand
+        f = info.fraz
+        pred = info.pred
+        top = [None for i in range(m + 1)]
+        heads = dict()
+        def make_head(k, n):
+            '''複製路徑 top[k][n] 的首個節點，其餘節點共用'''
+            if (k, n) in heads:
+                return heads[(k, n)]
+            prob, e, j, r = top[k][n]
+            rest = make_head(j, r) if j < m else None
+            nodes = e.get_all()
+            head = rest
+            for y in reversed(nodes[1:]):
+                head = Entry(y.e, y.i, y.j, y.prob, 0, head)
+            head = heads[(k, n)] = Entry(e.e, e.i, e.j, prob, 0, head)
+            return head
+        ends = [j for j in reversed(b)]
+        sentences = [[] for i in range(m + 1)]
+        for i in range(m - 1, -1, -1):
+            edges = []
+            for j in ends:
+                if j <= i:
+                    break
+                if c[i][j]:
+                    edges.extend((x, j) for x in c[i][j])
+            for k in range(i + 1, m + 1):
+                if f[i][k]:
+                    edges.extend((x, k) for x in f[i][k])
+            paths = []
+            for e, k in heapq.nlargest(beam, edges, key=lambda t: t[0].prob):
+                if k == m:
+                    paths.append((e.prob, e, k, None))
+                elif top[k]:
+                    base = e.prob - pred[k].prob
+                    paths.extend((base + top[k][n][0], e, k, n) for n in range(len(top[k])))
+            top[i] = heapq.nlargest(beam, paths, key=lambda t: t[0])
+            for n, (prob, e, k, r) in enumerate(top[i]):
+                if k < m or e.next:
+                    sentences[i].append(make_head(i, n))
+        return sentences
+
     def train(self, ctx, s):
 
         def g(ikeys, okey, depth):
@@ -328,13 +588,14 @@ class Model:
             return g(r, okey[1:], depth + 1)
 
         indexer = lambda okey: [u' '.join(ikey) for ikey in g([[]], okey.split(), 0)]
+        db = ctx.schema.get_db()
         last = None
         for e in s:
             if last:
-                self.__db.update_bigram(last, e, indexer)
+                db.update_bigram(last, e, indexer)
             last = e
-            self.__db.update_unigram(e)
-        self.__db.update_freq_total(len(s))
+            db.update_unigram(e)
+        db.update_freq_total(len(s))
         ctx.info = self.create_context_info()
         ctx.info.last = Entry(last.e, -1, 0, last.prob, last.use_count + 1) if last else None
 
@@ -344,7 +605,7 @@ class Model:
         fraz = ctx.info.fraz
         pred = ctx.info.pred
         if i >= m:
-            return []
+            return CandidateList([])
         if i == -1:
             i = ctx.sel[-1].j if ctx.sel else 0
         if j == -1:
@@ -404,19 +665,8 @@ class Model:
                     r[j].append(ex)
                     break
             #print 'supplemented:', r[j][0].get_phrase()
-        cand_cmp = lambda a, b: -cmp(a.use_count + a.prob, b.use_count + b.prob)
-        ret = []
-        for s in reversed(r):  # longer words come first
-            if s:
-                phrases = set()
-                for e in sorted(s, cand_cmp):
-                    p = e.get_phrase()
-                    # ignore less freqently used phrases with identical representation
-                    if p not in phrases:
-                        phrases.add(p)
-                        ret.append((p, e))
-        """
-        for x in ret[:5]:
-            print u'[DEBUG] cand: %s' % x[1]
-        """
-        return ret
+        # k-best sentences from the beam decoder
+        if j == m and ctx.info.sentences:
+            r[m].extend(ctx.info.sentences[i])
+        # longer words come first
+        return CandidateList(reversed(r))
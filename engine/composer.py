@@ -177,7 +177,7 @@ class RomanComposer(Composer):
             ctx.edit([])
             return Spelling(self.spelling)
         # 不可轉換的輸入串，追加符號後轉入西文模式
-        if ctx.err and self.acceptable(ch) and not ch in self.alphabet:
+        if ctx.has_error() and self.acceptable(ch) and not ch in self.alphabet:
             self.spelling = u''.join(self.__input)
             self.__input = []
             ctx.edit([])
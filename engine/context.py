@@ -3,11 +3,79 @@
 
 # TODO: 細分為保存寫作狀態的Context對象，和實現各種編輯操作的Editor
 
+import Queue
+import atexit
+import threading
+
 from builder import *
+from profiler import Profiler
+from storage import debug
 
 # 识别一组非整句的词组候选
 is_phrase_list = lambda x: x and (len(x) != 1 or x[0].use_count != 0)
 
+
+class QueryWorker(threading.Thread):
+
+    '''後台查詢線程
+
+    各會話的異步查詢在此線程中依次執行
+    隊列中的每一項為一個callable，由Context提交
+
+    '''
+
+    __instance = None
+    __lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        with cls.__lock:
+            if not cls.__instance:
+                cls.__instance = QueryWorker()
+                cls.__instance.start()
+                atexit.register(cls.__instance.stop)
+            return cls.__instance
+
+    def __init__(self):
+        super(QueryWorker, self).__init__(name='zime-query')
+        self.daemon = True
+        self.__queue = Queue.Queue()
+
+    def submit(self, task):
+        self.__queue.put(task)
+
+    def stop(self):
+        '''處理完隊列中的任務後結束線程'''
+        self.__queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            task = self.__queue.get()
+            if task is None:
+                return
+            try:
+                task()
+            except Exception, e:
+                debug('query worker:', e)
+
+
+class Query(object):
+
+    '''一次異步查詢
+
+    generation為提交時Context的編輯序號，序號過時的查詢結果即被丟棄
+
+    '''
+
+    def __init__(self, generation, input, start_conversion):
+        self.generation = generation
+        # 主線程會繼續改動輸入串，故保存一份副本
+        self.input = input[:]
+        self.start_conversion = start_conversion
+        self.error = None
+
+
 class Context:
 
     '''輸入上下文
@@ -18,7 +86,7 @@ class Context:
         # 上下文更新後通過on_update() callback反饋給前端
         self.__update_notifiers = []
         # Context調用Model完成輸入串到預測結果的轉換，並取得所有相關候選詞
-        self.__model = Model(schema)
+        self.__model = Model.for_schema(schema)
         # 以下讀取Context關心的設定值
         self.__delimiter = schema.get_config_char_sequence(u'Delimiter') or u' '
         self.__auto_delimit = schema.get_config_value(u'AutoDelimit') in (u'yes', u'true')
@@ -31,9 +99,110 @@ class Context:
             self.__translit = lambda s: u''.join([xlit[c] if c in xlit else c for c in s])
         else:
             self.__translit = None
+        # 異步查詢；未開啟時在當前線程中同步查詢
+        self.__worker = None
+        self.__call_soon = None
+        self.__cond = threading.Condition()
+        # 每次編輯輸入串遞增，用以識別過時的查詢
+        self.__generation = 0
+        # 等待結果的查詢，及後台線程是否仍有此Context的查詢任務
+        self.__pending = None
+        self.__queued = False
+        # 推遲查詢，直到需要讀取查詢結果
+        self.__deferred = False
         # 置為初始狀態
         self.__reset()
 
+    def enable_async_query(self, call_soon):
+        '''開啟異步查詢
+
+        輸入串交由後台線程查詢，前端即時回顯輸入串；結果就緒後經call_soon交回前端的主線程更新
+        連續擊鍵時只有最後一次編輯的結果會送到前端，過時的查詢被跳過或其結果被丟棄
+        需要讀取查詢結果的操作，會先等待未完成的查詢
+
+        '''
+        self.__worker = QueryWorker.get_instance()
+        self.__call_soon = call_soon
+
+    def defer_query(self, deferred=True):
+        '''推遲查詢
+
+        用於批量處理鍵盤事件：編輯輸入串時只記下待查詢的輸入串，讀取查詢結果時才查詢最後一次編輯的結果
+        結束推遲時即查詢；開啟了異步查詢的，仍由後台線程送達結果
+
+        '''
+        self.__deferred = deferred
+        if not deferred and not self.__worker:
+            self.__sync()
+
+    def is_pending(self):
+        '''查詢結果尚未就緒，將由後台線程送達'''
+        return self.__pending is not None and self.__worker is not None
+
+    def __submit(self, start_conversion):
+        with self.__cond:
+            self.__pending = Query(self.__generation, self.input, start_conversion)
+            if self.__worker and not self.__queued:
+                self.__queued = True
+                self.__worker.submit(self.__run_query)
+
+    def __run_query(self):
+        '''在後台線程中執行，直到沒有新的查詢'''
+        while True:
+            with self.__cond:
+                q = self.__pending
+                if q is None:
+                    self.__queued = False
+                    self.__cond.notify_all()
+                    return
+            try:
+                self.__model.query(self, q.input)
+            except Exception, e:
+                q.error = e
+            with self.__cond:
+                if q is self.__pending:
+                    self.__queued = False
+                    self.__cond.notify_all()
+                    break
+                # 查詢期間又有新的輸入，丟棄本次結果
+        self.__call_soon(lambda: self.__finish(q))
+
+    def __wait(self):
+        '''等待後台線程完成此Context的查詢'''
+        with self.__cond:
+            while self.__queued:
+                self.__cond.wait()
+
+    def __cancel(self):
+        '''放棄未完成的查詢'''
+        with self.__cond:
+            self.__generation += 1
+            self.__pending = None
+        self.__wait()
+
+    def __sync(self):
+        '''有未完成的查詢時，等待其結束並即時更新結果'''
+        q = self.__pending
+        if q is None:
+            return
+        if self.__worker:
+            self.__wait()
+            self.__finish(q)
+        else:
+            # 推遲的查詢，在當前線程中執行
+            self.__pending = None
+            self.__model.query(self, q.input)
+            self.__update(q.input, q.start_conversion)
+
+    def __finish(self, q):
+        '''在主線程中更新查詢結果；查詢已過時或已更新過的，不作處理'''
+        if q is not self.__pending or q.generation != self.__generation:
+            return
+        self.__pending = None
+        if q.error:
+            raise q.error
+        self.__update(q.input, q.start_conversion)
+
     def add_update_notifier(self, notifier):
         self.__update_notifiers.append(notifier)
 
@@ -42,6 +211,9 @@ class Context:
             notifier.on_update()
 
     def __reset(self, keep_context=False):
+        if not keep_context:
+            # 後台線程可能仍在改寫self.info
+            self.__cancel()
         # 輸入串，可以是字符序列（如在羅馬字解析方式下）或音節編碼的序列
         self.input = []
         # 錯誤狀態，非空時為一個Entry對象標記輸入串中輸入出錯的位置
@@ -84,6 +256,7 @@ class Context:
         處理結果上屏事件
         當前算法，上屏動作由Engine發出，這是上屏後由Context響應的事件處理函數，並無上屏的具體操作
         '''
+        self.__sync()
         if self.is_completed():
             # 學一遍
             self.__model.train(self, self.sel + self.cur)
@@ -100,8 +273,21 @@ class Context:
         '''
         self.__reset(keep_context=True)
         self.input = input
+        with self.__cond:
+            self.__generation += 1
+            self.__pending = None
+        if input and (self.__worker or self.__deferred):
+            # 先回顯輸入串，待查詢完成再更新
+            self.__submit(start_conversion)
+            self.notify_update()
+            return
         if input:
             self.__model.query(self)
+        self.__update(input, start_conversion)
+
+    def __update(self, input, start_conversion):
+        '''依查詢結果更新展現串、預測結果及候選詞列表'''
+        if input:
             m, n = self.info.m, self.info.n
             self.__calculate_display_string(input, self.info.d, n, m)
             if m != n:
@@ -119,6 +305,7 @@ class Context:
 
     def has_error(self):
         '''錯誤的輸入串'''
+        self.__sync()
         return self.err is not None
 
     def cancel_conversion(self):
@@ -262,6 +449,7 @@ class Context:
 
     def forward(self):
         '''確認當前候選詞，並將選詞光標移動到後續的詞'''
+        self.__sync()
         c = self.cur
         if c:
             self.sel.extend(c)
@@ -271,7 +459,8 @@ class Context:
     def __update_candidates(self, i=-1, j=-1):
         '''更新候選詞列表'''
         #print '__update_candidates:', i, j
-        self.__candidates = self.__model.make_candidate_list(self, i, j)
+        with Profiler.phase('candidates'):
+            self.__candidates = self.__model.make_candidate_list(self, i, j)
         if self.__candidates:
             # 高亮顯示第一個候選詞
             self.cur = self.__candidates[0][1].get_all()
@@ -285,14 +474,21 @@ class Context:
 
     def select(self, e):
         '''從候選詞列表中手工選定一條候選詞'''
+        self.__sync()
         self.cur = e.get_all()
 
     def being_converted(self):
         '''轉換模式'''
+        q = self.__pending
+        if q is not None and not q.start_conversion:
+            # 不要求轉換的查詢，完成後也沒有選中的詞，不必等待
+            return False
+        self.__sync()
         return bool(self.cur)
 
     def is_completed(self):
         '''轉換完畢'''
+        self.__sync()
         return self.cur and self.cur[-1].j == len(self.input)
 
     def __calculate_display_string(self, s, d, n, m):
@@ -315,6 +511,7 @@ class Context:
 
     def get_sentence(self):
         '''取得編輯中的文字'''
+        self.__sync()
         if self.is_empty():
             return u''
         r = []
@@ -343,6 +540,7 @@ class Context:
 
     def get_commit_string(self):
         '''取得上屏文字'''
+        self.__sync()
         i = 0
         r = []
         for s in self.sel + self.cur:
@@ -355,14 +553,21 @@ class Context:
 
     def get_display_string(self):
         '''取得編碼串'''
+        self.__sync()
         return self.__display[0]
 
     def get_input_string(self):
         '''取得輸入串'''
         return u''.join(self.input)
+
+    def get_echo_string(self):
+        '''取得查詢結果就緒之前回顯的輸入串'''
+        s = self.get_input_string()
+        return self.__translit(s) if self.__translit else s
         
     def get_prompt(self):
         '''取得回顯串（已確認文字＋選擇區編碼）'''
+        self.__sync()
         if self.is_empty():
             return u'', 0, 0
         r = []
@@ -416,6 +621,7 @@ class Context:
 
     def get_candidates(self):
         '''取得當前候選詞'''
+        self.__sync()
         return self.__candidates
 
     def delete_phrase(self, e):
@@ -54,6 +54,10 @@ class Frontend(object):
     '''抽象的前端
     '''
 
+    # call_soon(func)：在前端主線程的事件循環中稍後執行func
+    # 異步查詢的結果經此交回主線程；無事件循環的前端（如【小狼毫】的請求／應答）為None
+    call_soon = None
+
     def commit_string(self, s):
         '''文字上屏
         '''
@@ -13,17 +13,27 @@ from core import *
 from composer import *
 from processor import *
 from context import *
+from profiler import Profiler
 from storage import DB
 
 def initialize():
     db_file=os.getenv('ZIME_DATABASE')
+    # 系統詞典與用戶詞典分離時，zime.db只存放用戶數據
+    system_db_file = os.getenv('ZIME_SYSTEM_DATABASE')
     if not db_file:
         home_path = os.path.expanduser('~')
         db_path = os.path.join(home_path, '.ibus', 'zime')
         if not os.path.isdir(db_path):
             os.makedirs(db_path)
         db_file = os.path.join(db_path, 'zime.db')
-    DB.open(db_file)
+        if not system_db_file and os.path.exists(os.path.join(db_path, 'zime-sys.db')):
+            system_db_file = os.path.join(db_path, 'zime-sys.db')
+    DB.open(db_file, system_db_file=system_db_file)
+    # 擊鍵耗時統計，以環境變量ZIME_PROFILE或設定Option/Profile = yes開啟
+    profile = os.getenv('ZIME_PROFILE') or DB.read_option(u'Profile')
+    Profiler.configure(profile not in (None, u'', u'0', u'no', u'false'),
+                       DB.read_option(u'SlowKeystroke'),
+                       DB.read_option(u'ProfileLogInterval'))
 
 initialize()
 
@@ -33,12 +43,107 @@ __all__ = (
 )
 
 
+class UpdateFilter(object):
+
+    '''記下已推送到前端的寫作串、輔助串和候選列表，內容不變的更新不再轉給前端
+
+    候選列表按對象比較：Context重新生成候選時才是新的列表，空列表之間視為相同
+    翻頁、移動選詞光標只改變前端自身的狀態，與此無關
+
+    '''
+
+    def __init__(self, frontend):
+        self.__frontend = frontend
+        self.reset()
+
+    def reset(self):
+        '''前端的狀態未知（如重新獲得焦點），此後的更新一律轉給前端'''
+        self.__preedit = None
+        self.__aux = None
+        self.__candidates = None
+        self.__has_candidates = None
+
+    def commit_string(self, s):
+        self.__frontend.commit_string(s)
+
+    def update_preedit(self, s, start=0, end=0):
+        if self.__preedit != (s, start, end):
+            self.__preedit = (s, start, end)
+            self.__frontend.update_preedit(s, start, end)
+
+    def update_aux(self, s, start=0, end=0):
+        if self.__aux != (s, start, end):
+            self.__aux = (s, start, end)
+            self.__frontend.update_aux(s, start, end)
+
+    def update_candidates(self, candidates):
+        has_candidates = bool(candidates)
+        if has_candidates == self.__has_candidates and \
+           (not has_candidates or candidates is self.__candidates):
+            return
+        self.__candidates = candidates
+        self.__has_candidates = has_candidates
+        self.__frontend.update_candidates(candidates)
+
+    def __getattr__(self, name):
+        return getattr(self.__frontend, name)
+
+
+class DeferredFrontend(object):
+
+    '''批量處理鍵盤事件期間代理前端
+
+    文字上屏即時轉給前端；寫作串、輔助串和候選列表只記下最後的狀態，批量處理結束時才更新到前端
+    翻頁、取候選序號等操作依賴前端的當前狀態，先更新再轉給前端
+
+    '''
+
+    def __init__(self, frontend, render):
+        self.__frontend = frontend
+        # render(frontend)：依Context的狀態更新前端
+        self.__render = render
+        self.__stale = False
+        self.__updates = dict()
+
+    def invalidate(self):
+        '''Context有變化，須重新生成前端的全部內容'''
+        self.__stale = True
+        self.__updates.clear()
+
+    def commit_string(self, s):
+        self.__frontend.commit_string(s)
+
+    def update_preedit(self, s, start=0, end=0):
+        self.__updates['update_preedit'] = (s, start, end)
+
+    def update_aux(self, s, start=0, end=0):
+        self.__updates['update_aux'] = (s, start, end)
+
+    def update_candidates(self, candidates):
+        self.__updates['update_candidates'] = (candidates,)
+
+    def flush(self):
+        if self.__stale:
+            self.__stale = False
+            self.__render(self.__frontend)
+        for k in ('update_preedit', 'update_aux', 'update_candidates'):
+            if k in self.__updates:
+                getattr(self.__frontend, k)(*self.__updates.pop(k))
+
+    def __getattr__(self, name):
+        self.flush()
+        return getattr(self.__frontend, name)
+
+
 class Engine(Processor):
 
     ROLLBACK_COUNTDOWN = 3  # seconds
 
     def __init__(self, frontend, schema_id=None):
-        self.__frontend = frontend
+        # 只推送有變化的內容
+        self.__filter = self.__frontend = UpdateFilter(frontend)
+        # 批量處理鍵盤事件期間為DeferredFrontend
+        self.__batch = None
         self.schema = None
         self.switcher = Switcher(self, schema_id)
         self.update_ui()
@@ -55,8 +160,52 @@ class Engine(Processor):
         self.__punct_rep = 0
         self.__rollback_time = 0
         self.__numeric = False
+        # 異步查詢，以設定值Option/AsyncQuery = yes開啟，須前端提供call_soon
+        call_soon = getattr(self.__frontend, 'call_soon', None)
+        if call_soon and DB.read_option(u'AsyncQuery') in (u'yes', u'true'):
+            self.ctx.enable_async_query(call_soon)
 
     def process_key_event(self, event):
+        if not Profiler.enabled or event.is_key_up():
+            return self.__process_key_event(event)
+        before = self.ctx.get_input_string() if self.schema else u''
+        Profiler.begin(self.schema.schema_id if self.schema else None)
+        try:
+            return self.__process_key_event(event)
+        finally:
+            after = self.ctx.get_input_string() if self.schema else u''
+            Profiler.end(keysyms.keycode_to_name(event.keycode), before, after)
+
+    def process_key_events(self, events):
+        '''批量處理鍵盤事件
+
+        用於粘貼、重放按鍵序列等：輸入串的查詢推遲到需要讀取結果時，前端只在最後更新一次
+        返回各事件是否已處理
+
+        '''
+        frontend = self.__frontend
+        ctx = self.ctx if self.schema else None
+        self.__batch = self.__frontend = DeferredFrontend(frontend, self.__update_ui)
+        if ctx:
+            ctx.defer_query()
+        try:
+            results = []
+            for event in events:
+                results.append(self.process_key_event(event))
+                # 其間切換了方案的，新的Context同樣推遲查詢
+                if self.schema and self.ctx is not ctx:
+                    ctx = self.ctx
+                    ctx.defer_query()
+            return results
+        finally:
+            if ctx:
+                ctx.defer_query(False)
+            batch = self.__batch
+            self.__batch = None
+            self.__frontend = frontend
+            batch.flush()
+
+    def __process_key_event(self, event):
         # disable engine when Caps Lock is on
         if event.mask & modifier.LOCK_MASK:
             return False
@@ -78,7 +227,7 @@ class Engine(Processor):
                     if event.mask & modifier.RELEASE_MASK == 0:
                         # delete phrase
                         index = self.__frontend.get_candidate_index(event.keycode - keysyms._1)
-                        if index >= 0 and index < len(candidates):
+                        if index >= 0 and candidates[index:index + 1]:
                             self.ctx.delete_phrase(candidates[index][1])
                     return True
             # ignore other hotkeys
@@ -110,7 +259,8 @@ class Engine(Processor):
                 return True
             self.__commit_punct()
             # continue processing
-        result = self.__composer.process_input(event, self.ctx)
+        with Profiler.phase('composer'):
+            result = self.__composer.process_input(event, self.ctx)
         if result is True:
             return True
         if result is False:
@@ -295,14 +445,14 @@ class Engine(Processor):
         if not candidates:
             return False
         index = self.__frontend.get_candidate_index(n)
-        if index >= 0 and index < len(candidates):
+        if index >= 0 and candidates[index:index + 1]:
             self.ctx.select(candidates[index][1])
             self.__confirm_current()
         return True
 
     def __select_by_cursor(self, candidates):
         index = self.__frontend.get_highlighted_candidate_index()
-        if index >= 0 and index < len(candidates):
+        if index >= 0 and candidates[index:index + 1]:
             self.ctx.select(candidates[index][1])
             if self.__auto_prompt:
                 self.__frontend.update_preedit(u'')
@@ -346,16 +496,40 @@ class Engine(Processor):
     def on_update(self):
         self.update_ui()
 
-    def update_ui(self):
+    def update_ui(self, force=False):
+        '''更新前端；force為True時，不論內容有無變化一律推送'''
+        if force:
+            self.__filter.reset()
+        if self.__batch:
+            self.__batch.invalidate()
+            return
+        with Profiler.phase('frontend'):
+            self.__update_ui(self.__frontend)
+
+    def __update_ui(self, frontend):
+        if self.ctx.is_pending():
+            self.__update_echo(frontend)
+            return
         if self.__auto_prompt:
-            self.__frontend.update_preedit(u'')
+            frontend.update_preedit(u'')
         else:
-            self.__frontend.update_preedit(self.ctx.get_sentence())
+            frontend.update_preedit(self.ctx.get_sentence())
         if self.__auto_prompt or self.ctx.being_converted():
-            self.__frontend.update_aux(*self.ctx.get_prompt())
+            frontend.update_aux(*self.ctx.get_prompt())
         else:
-            self.__frontend.update_aux(u'')
-        self.__frontend.update_candidates(self.ctx.get_candidates())
+            frontend.update_aux(u'')
+        frontend.update_candidates(self.ctx.get_candidates())
+
+    def __update_echo(self, frontend):
+        '''查詢結果就緒之前，先回顯輸入串'''
+        s = self.ctx.get_echo_string()
+        if self.__auto_prompt:
+            frontend.update_preedit(u'')
+            frontend.update_aux(s)
+        else:
+            frontend.update_preedit(s)
+            frontend.update_aux(u'')
+        frontend.update_candidates([])
         
     # MenuEventHandler
 
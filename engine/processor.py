@@ -6,6 +6,7 @@ __all__ = (
     "Switcher",
 )
 
+import threading
 import time
 from core import *
 from storage import DB
@@ -94,20 +95,38 @@ class Switcher(MenuProcessor):
 
     '''
 
+    # 各會話共用的方案列表，首次取用時載入，開啟選單時重新載入
+    __shared_schema_list = None
+    __lock = threading.Lock()
+
     def __init__(self, handler, schema_id=None):
         super(Switcher, self).__init__(handler)
-        self.__load_schema_list()
+        self.__schema_list = Switcher.get_schema_list()
         self.choose(schema_id)
 
-    def __load_schema_list(self):
-        '''載入方案列表'''
+    @classmethod
+    def get_schema_list(cls):
+        '''取得按最近選用的時間排列的方案列表 [(schema_id, name)]'''
+        with cls.__lock:
+            if cls.__shared_schema_list is None:
+                cls.__shared_schema_list = cls.__read_schema_list()
+            return cls.__shared_schema_list
+
+    @staticmethod
+    def __read_schema_list():
         tempo = dict()
         for schema, t in DB.read_setting_items(u'SchemaChooser/LastUsed/'):
             tempo[schema] = float(t)
         # 按最近選用的時間順序排列
         last_used_time = lambda s: tempo[s[0]] if s[0] in tempo else 0.0
-        schema_list = sorted(DB.read_setting_items(u'SchemaList/'),
-                             key=last_used_time, reverse=True)
+        return sorted(DB.read_setting_items(u'SchemaList/'),
+                      key=last_used_time, reverse=True)
+
+    def __load_schema_list(self):
+        '''載入方案列表'''
+        schema_list = Switcher.__read_schema_list()
+        with Switcher.__lock:
+            Switcher.__shared_schema_list = schema_list
         self.__schema_list = schema_list
 
     def choose(self, schema_id):
@@ -124,12 +143,16 @@ class Switcher(MenuProcessor):
         if index == -1:
             # 無可用的方案
             return
-        # 記錄選用方案的時間
-        now = time.time()        
-        DB.update_setting(
-            u'SchemaChooser/LastUsed/%s' % schema_ids[index],
-            unicode(now)
-        )
+        # 記錄選用方案的時間；已是最近選用的方案，則次序不變，不必寫入
+        if index > 0:
+            now = time.time()
+            DB.update_setting(
+                u'SchemaChooser/LastUsed/%s' % schema_ids[index],
+                unicode(now)
+            )
+            with Switcher.__lock:
+                Switcher.__shared_schema_list = [self.__schema_list[index]] + \
+                    [x for x in Switcher.__shared_schema_list if x[0] != schema_ids[index]]
         # 執行切換
         self.deactivate()
         self.handler.on_schema_change(schema_ids[index], names[index])
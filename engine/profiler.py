@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# vim:set et sts=4 sw=4:
+
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+def report(*what):
+    print >> sys.stderr, u'[PROFILE]: ', u' '.join(map(unicode, what))
+
+
+class Histogram:
+
+    '''最近若干次取樣的滾動統計'''
+
+    def __init__(self, window):
+        self.__samples = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, x):
+        self.__samples.append(x)
+        self.count += 1
+
+    def summary(self):
+        s = sorted(self.__samples)
+        if not s:
+            return None
+        pick = lambda p: s[min(len(s) - 1, int(len(s) * p))]
+        return {
+            'count': self.count,
+            'mean': sum(s) / len(s),
+            'p50': pick(0.50),
+            'p95': pick(0.95),
+            'p99': pick(0.99),
+            'max': s[-1],
+        }
+
+
+class Profiler:
+
+    '''擊鍵耗時統計
+
+    以環境變量ZIME_PROFILE或設定Option/Profile = yes開啟；未開啟時各處的計時都被跳過
+    每次擊鍵分階段計時，按方案累計各階段的滾動統計，單位為毫秒
+    耗時超過Option/SlowKeystroke毫秒的擊鍵連同其前後的輸入串一併記下，以便重現
+    每隔Option/ProfileLogInterval秒輸出一行匯總
+
+    '''
+
+    PHASES = ('composer', 'segmentation', 'lookup_sql', 'lookup_python',
+              'sentence', 'candidates', 'frontend', 'total')
+    WINDOW = 1000
+    SLOW_KEYSTROKE = 50.0   # ms
+    SLOW_LIMIT = 100
+    LOG_INTERVAL = 60.0     # seconds
+
+    enabled = False
+    __lock = threading.Lock()
+    __local = threading.local()
+    __stats = dict()
+    __slow = deque(maxlen=SLOW_LIMIT)
+    __last_log = 0
+
+    @classmethod
+    def configure(cls, enabled, slow_keystroke=None, log_interval=None):
+        cls.enabled = enabled
+        if slow_keystroke:
+            cls.SLOW_KEYSTROKE = float(slow_keystroke)
+        if log_interval:
+            cls.LOG_INTERVAL = float(log_interval)
+        cls.__last_log = time.time()
+
+    @classmethod
+    def reset(cls):
+        with cls.__lock:
+            cls.__stats = dict()
+            cls.__slow.clear()
+
+    @classmethod
+    def begin(cls, schema_id):
+        '''開始一次擊鍵的計時；可嵌套，以最外層為準'''
+        r = getattr(cls.__local, 'record', None)
+        if r:
+            r['depth'] += 1
+            return
+        cls.__local.record = {'depth': 1, 'schema': schema_id, 'sql': 0.0,
+                              'phases': dict(), 'start': time.time()}
+
+    @classmethod
+    def end(cls, key, before, after):
+        '''結束計時；key為按鍵，before與after為擊鍵前後的輸入串'''
+        r = getattr(cls.__local, 'record', None)
+        if not r:
+            return
+        r['depth'] -= 1
+        if r['depth'] > 0:
+            return
+        cls.__local.record = None
+        now = time.time()
+        phases = r['phases']
+        phases['total'] = (now - r['start']) * 1000
+        with cls.__lock:
+            stats = cls.__stats.setdefault(r['schema'], dict())
+            for k, v in phases.iteritems():
+                if k not in stats:
+                    stats[k] = Histogram(cls.WINDOW)
+                stats[k].add(v)
+            slow = phases['total'] >= cls.SLOW_KEYSTROKE
+            if slow:
+                cls.__slow.append((now, r['schema'], key, before, after, dict(phases)))
+            log = cls.LOG_INTERVAL and now - cls.__last_log >= cls.LOG_INTERVAL
+            if log:
+                cls.__last_log = now
+        if slow:
+            report(u'slow keystroke: %s %s [%s] -> [%s] %s' %
+                   (r['schema'], key, before, after, cls.__format(phases)))
+        if log:
+            for schema_id, s in cls.stats().iteritems():
+                report(u'%s: %s' % (schema_id, u', '.join(
+                    [u'%s p50 %.1f p95 %.1f p99 %.1f' % (k, s[k]['p50'], s[k]['p95'], s[k]['p99'])
+                     for k in cls.PHASES if k in s])))
+
+    @classmethod
+    def add(cls, phase, ms):
+        r = getattr(cls.__local, 'record', None)
+        if r:
+            phases = r['phases']
+            phases[phase] = phases.get(phase, 0.0) + ms
+
+    @classmethod
+    def add_sql(cls, seconds):
+        '''由數據庫連接池登記查詢耗時'''
+        r = getattr(cls.__local, 'record', None)
+        if r:
+            r['sql'] += seconds
+
+    @classmethod
+    @contextmanager
+    def phase(cls, name, split_sql=False):
+        '''為一個階段計時；split_sql時分別記錄其中SQL查詢與Python代碼的耗時'''
+        r = getattr(cls.__local, 'record', None)
+        if not r:
+            yield
+            return
+        sql = r['sql']
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            if split_sql:
+                sql = r['sql'] - sql
+                cls.add(name + '_sql', sql * 1000)
+                cls.add(name + '_python', (elapsed - sql) * 1000)
+            else:
+                cls.add(name, elapsed * 1000)
+
+    @classmethod
+    def stats(cls, schema_id=None):
+        '''返回 {schema_id: {phase: {count, mean, p50, p95, p99, max}}}'''
+        with cls.__lock:
+            result = dict()
+            for k, stats in cls.__stats.iteritems():
+                if schema_id is None or k == schema_id:
+                    result[k] = dict([(p, h.summary()) for p, h in stats.iteritems()])
+            return result
+
+    @classmethod
+    def slow_keystrokes(cls):
+        '''返回最近的慢擊鍵 [(time, schema_id, key, before, after, {phase: ms})]'''
+        with cls.__lock:
+            return list(cls.__slow)
+
+    @staticmethod
+    def __format(phases):
+        return u' '.join([u'%s=%.1f' % (k, phases[k]) for k in Profiler.PHASES if k in phases])
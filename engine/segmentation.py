@@ -1,8 +1,26 @@
 # -*- coding: utf-8 -*-
 # vim:set et sts=4 sw=4:
 
+import bisect
+import heapq
 import re
 
+class SegmentationInfo(object):
+
+    '''保存上一次切分的中間結果，供編輯輸入串後增量計算'''
+
+    def __init__(self):
+        # 上一次切分的輸入串
+        self.input = []
+        # a[i]記錄自位置i起的各個切分，以結束位置為鍵；into[j]依次記錄結束於位置j的切分之起始位置
+        self.a = [dict()]
+        self.into = [[]]
+        # 可切分的位置
+        self.p = []
+        # 依次處理過的位置，及處理時讀到的最遠的輸入位置
+        self.done = []
+
+
 class Segmentor(object):
 
     def __init__(self, schema, sa):
@@ -13,54 +31,112 @@ class Segmentor(object):
         compile_repl_pattern = lambda x: (re.compile(x[0]), x[1])
         self.__split_rules = get_rules(compile_repl_pattern, u'SplitRule')
         self.__divide_rules = get_rules(compile_repl_pattern, u'DivideRule')
+        self.__trie = self.__build_trie(sa.spelling_map)
 
-    def __is_keyword(self, k):
-        return k in self.__sa.spelling_map
+    def __build_trie(self, spelling_map):
+        '''以拼寫為鍵建立字典樹，葉結點以None為鍵保存對應的編碼'''
+        root = dict()
+        for k, v in spelling_map.iteritems():
+            if len(k) > self.__max_keyword_length:
+                continue
+            node = root
+            for c in k:
+                node = node.setdefault(c, dict())
+            node[None] = v
+        return root
 
-    def __translate_keyword(self, k):
-        s = self.__sa.spelling_map
-        if k in s:
-            return s[k]
-        else:
-            return k
+    def __rewind(self, info, input_string):
+        '''
+        撤銷受輸入串變動影響的切分結果
+        自變動處起重新匹配的位置，只限於上次匹配時讀到了變動處的那些；返回待處理的位置
+        '''
+        n = len(input_string)
+        prev = info.input
+        k = 0
+        while k < len(prev) and k < n and prev[k] == input_string[k]:
+            k += 1
+        done = info.done
+        x = 0
+        while x < len(done) and done[x][1] < k:
+            x += 1
+        # 自r起的位置需要重新處理
+        r = done[x][0] if x < len(done) else (k if done else 0)
+        del done[x:]
+        p = info.p
+        del p[bisect.bisect_left(p, r):]
+        a = info.a
+        into = info.into
+        keep = min(len(a), n + 1)
+        del a[keep:]
+        del into[keep:]
+        for i in range(r, keep):
+            a[i] = dict()
+            h = into[i]
+            while h and h[-1] >= r:
+                h.pop()
+        a.extend(dict() for i in range(keep, n + 1))
+        into.extend([] for i in range(keep, n + 1))
+        info.input = list(input_string)
+        if r == 0:
+            return [0]
+        return [t for t in range(r, n + 1) if into[t]]
 
-    def segmentation(self, input_string):
+    def segmentation(self, input_string, info=None):
+        '''
+        切分輸入串
+        傳入上一次切分所用的info時，只重做輸入串變動之後的部份
+        '''
+        if info is None:
+            info = SegmentationInfo()
         n = len(input_string)
-        m = 0
-        a = [[None] * j for j in range(n + 1)]
-        p = []
-        q = [0]
+        # 待處理的切分位置，以最小堆按先後次序取出
+        q = self.__rewind(info, input_string)
+        queued = set(q)
+        a = info.a
+        into = info.into
+        p = info.p
+        done = info.done
+        m = max(q[-1] if q else 0, done[-1][0] if done else 0)
         def allow_divide(i, j, s):
-            flag = True
-            for k in p:
-                if not a[j][k]:
-                    if flag and a[i][k]:
-                        return True
-                    else:
-                        continue
+            h = [k for k in into[j] if k < i]
+            # 先有切分到達i，而尚無切分到達j
+            if into[i] and (not h or into[i][0] < h[0]):
+                return True
+            for k in h:
                 lw = u''.join(input_string[k:j])
                 for r in self.__divide_rules:
                     m = r[0].search(lw)
                     if m and r[0].sub(r[1], lw, 1) == s:
                         return True
-                flag = False
             return False
         while q:
-            i = q.pop(0)
+            i = heapq.heappop(q)
             if i == n:
                 p.append(i)
+                done.append((i, n))
                 break
             # TODO: implement split rules
             ok = False
             beyond_delimiter = False
+            # 自位置i起沿字典樹逐字匹配，一趟找出所有以i起始的拼寫
+            node = self.__trie
+            length = 0
+            reach = i
             for j in range(i + 1, n + 1):
+                reach = j
                 if beyond_delimiter:
                     break
-                s = u''.join(input_string[i:j])
-                if len (s) > self.__max_keyword_length:
+                x = input_string[j - 1]
+                length += len(x)
+                if length > self.__max_keyword_length:
+                    break
+                for c in x:
+                    node = node.get(c)
+                    if node is None:
+                        break
+                if node is None:
                     break
-                ##print j, s
-                if not self.__is_keyword(s):
+                if None not in node:
                     continue
                 if j < n and input_string[j] in self.__delimiter:
                     t = j + 1
@@ -68,34 +144,38 @@ class Segmentor(object):
                 else:
                     t = j
                 ##print i, t, s
-                if t not in q:
-                    q.append(t)
+                if t not in queued:
+                    queued.add(t)
+                    heapq.heappush(q, t)
                     m = max(m, t)
-                elif not allow_divide(i, t, s):
+                elif not allow_divide(i, t, u''.join(input_string[i:j])):
                     continue
-                a[t][i] = self.__translate_keyword(s)
+                if t not in a[i]:
+                    into[t].append(i)
+                a[i][t] = node[None]
                 ok = True
+            done.append((i, reach))
             if ok:
                 p.append(i)
-            q.sort()
         if m < n:
-            p.append(m)
+            p = p + [m]
         b = []
         d = []
         e = [[] for i in range(m + 1)]
+        reachable = set()
         # path finding
         for i in reversed(p):
             ok = i == m
-            for j in b:
-                if i < j and a[j][i]:
+            for j in sorted(a[i], reverse=True):
+                if j in reachable:
                     ok = True
-                    d = [k for k in d if k >= j]
-                    e[i].append((j, a[j][i]))
+                    while d and d[-1] < j:
+                        d.pop()
+                    e[i].append((j, a[i][j]))
             if ok:
                 b.append(i)
                 d.append(i)
-            else:
-                a[i] = [None for j in range(len(a[i]))]
+                reachable.add(i)
         b.reverse()
         d.reverse()
         return m, n, b, d, e
@@ -2,9 +2,19 @@
 # vim:set et sts=4 sw=4:
 
 import os
+import Queue
+import atexit
+import mmap
 import sqlite3
+import struct
 import sys
+import threading
 import time
+import urllib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from profiler import Profiler
 
 
 def debug(*what):
@@ -13,7 +23,7 @@ def debug(*what):
 
 # sql for global tables
 
-INIT_ZIME_DB_SQL = """
+INIT_USER_DB_SQL = """
 CREATE TABLE IF NOT EXISTS setting_paths (
     id INTEGER PRIMARY KEY,
     path TEXT UNIQUE
@@ -23,7 +33,9 @@ CREATE TABLE IF NOT EXISTS setting_values (
     path_id INTEGER,
     value TEXT
 );
+"""
 
+INIT_ZIME_DB_SQL = INIT_USER_DB_SQL + """
 CREATE TABLE IF NOT EXISTS phrases (
     id INTEGER PRIMARY KEY,
     phrase TEXT UNIQUE
@@ -35,7 +47,8 @@ SELECT value FROM setting_values WHERE path_id IN (SELECT id FROM setting_paths
 """
 
 QUERY_SETTING_ITEMS_SQL = """
-SELECT path, value FROM setting_paths, setting_values WHERE path LIKE :pattern AND id = path_id;
+SELECT path, value FROM setting_paths, setting_values WHERE path LIKE :pattern AND id = path_id
+ORDER BY setting_values.rowid;
 """
 
 QUERY_SETTING_PATH_SQL = """
@@ -74,14 +87,87 @@ FROM setting_paths p LEFT JOIN setting_values v ON p.id = v.path_id
 WHERE path LIKE '%/Dict';
 """
 
+# 分離系統詞典時，設定值來自用戶詞典 main 與系統詞典 sys 兩處，用戶設定在前
+
+QUERY_SPLIT_SETTING_SQL = """
+SELECT value FROM (
+    SELECT value, 0 AS src, v.rowid AS r FROM main.setting_values v
+    WHERE path_id IN (SELECT id FROM main.setting_paths WHERE path = :path)
+    UNION ALL
+    SELECT value, 1 AS src, v.rowid AS r FROM sys.setting_values v
+    WHERE path_id IN (SELECT id FROM sys.setting_paths WHERE path = :path)
+) ORDER BY src, r;
+"""
+
+QUERY_SPLIT_SETTING_ITEMS_SQL = """
+SELECT path, value FROM (
+    SELECT path, value, 0 AS src, v.rowid AS r FROM main.setting_paths p, main.setting_values v
+    WHERE path LIKE :pattern AND p.id = path_id
+    UNION ALL
+    SELECT path, value, 1 AS src, v.rowid AS r FROM sys.setting_paths p, sys.setting_values v
+    WHERE path LIKE :pattern AND p.id = path_id
+) ORDER BY src, r;
+"""
+
+QUERY_SPLIT_SCHEMA_LIST_SQL = """
+SELECT substr(path, length('SchemaList/') + 1), value FROM sys.setting_paths p 
+LEFT JOIN sys.setting_values v ON p.id = v.path_id 
+WHERE path LIKE 'SchemaList/%';
+"""
+
+QUERY_SPLIT_DICT_PREFIX_SQL = """
+SELECT substr(path, 1, length(path) - length('/Dict')), value 
+FROM sys.setting_paths p LEFT JOIN sys.setting_values v ON p.id = v.path_id 
+WHERE path LIKE '%/Dict';
+"""
+
 QUERY_PHRASE_SQL = """
 SELECT id FROM phrases WHERE phrase = :phrase;
 """
 
-ADD_PHRASE_SQL = """
-INSERT INTO phrases VALUES (NULL, :phrase);
+# 批量導入詞條：先寫入臨時表，再以集合操作解析各id
+
+CREATE_BULK_PHRASES_SQL = """
+CREATE TEMP TABLE bulk_phrases (
+    phrase TEXT,
+    okey TEXT,
+    freq INTEGER
+);
+"""
+
+CREATE_BULK_KEYS_SQL = """
+CREATE TEMP TABLE bulk_keys (
+    okey TEXT,
+    ikey TEXT
+);
 """
 
+CREATE_BULK_KEYS_INDEX_SQL = """
+CREATE INDEX temp.bulk_keys_idx ON bulk_keys (okey);
+"""
+
+CREATE_BULK_UNIGRAMS_INDEX_SQL = """
+CREATE INDEX temp.bulk_unigrams_idx ON bulk_unigrams (u_id);
+"""
+
+ADD_BULK_PHRASE_SQL = """
+INSERT INTO temp.bulk_phrases VALUES (?, ?, ?);
+"""
+
+ADD_BULK_KEY_SQL = """
+INSERT INTO temp.bulk_keys VALUES (?, ?);
+"""
+
+BULK_ADD_PHRASES_SQL = """
+INSERT OR IGNORE INTO phrases (phrase) SELECT phrase FROM temp.bulk_phrases ORDER BY rowid;
+"""
+
+DROP_BULK_TABLES_SQL = [
+    "DROP TABLE IF EXISTS temp.bulk_phrases;",
+    "DROP TABLE IF EXISTS temp.bulk_keys;",
+    "DROP TABLE IF EXISTS temp.bulk_unigrams;",
+]
+
 # dict specific sql
 
 CREATE_DICT_SQL = """
@@ -169,19 +255,24 @@ QUERY_UNIGRAM_SQL = """
 SELECT phrase, okey, u.id, sfreq + ufreq AS freq, ufreq 
 FROM %(prefix)s_unigram u, %(prefix)s_ku ku, %(prefix)s_keys k, phrases p 
 WHERE ikey = :ikey AND k.id = k_id AND u_id = u.id AND p_id = p.id
-ORDER BY freq DESC;
+ORDER BY freq DESC, u.id;
 """
 
-UNIGRAM_EXIST_SQL = """
-SELECT id FROM %(prefix)s_unigram WHERE p_id = :p_id AND okey = :okey;
+QUERY_UNIGRAM_MANY_SQL = """
+SELECT ikey, phrase, okey, u.id, sfreq + ufreq AS freq, ufreq
+FROM %(prefix)s_unigram u, %(prefix)s_ku ku, %(prefix)s_keys k, phrases p
+WHERE ikey IN (%%s) AND k.id = k_id AND u_id = u.id AND p_id = p.id
+ORDER BY ikey, freq DESC, u.id;
 """
 
-ADD_UNIGRAM_SQL = """
-INSERT INTO %(prefix)s_unigram VALUES (NULL, :p_id, :okey, :freq, 0);
+QUERY_UNIGRAM_INDEX_SQL = """
+SELECT ikey, phrase, okey, u.id, sfreq + ufreq AS freq, ufreq
+FROM %(prefix)s_unigram u, %(prefix)s_ku ku, %(prefix)s_keys k, phrases p
+WHERE k.id = k_id AND u_id = u.id AND p_id = p.id;
 """
 
-INC_SFREQ_SQL = """
-UPDATE %(prefix)s_unigram SET sfreq = sfreq + :freq WHERE id = :id;
+UNIGRAM_EXIST_SQL = """
+SELECT id FROM %(prefix)s_unigram WHERE p_id = :p_id AND okey = :okey;
 """
 
 INC_UFREQ_SQL = """
@@ -194,6 +285,12 @@ WHERE ikey = :ikey AND k.id = k_id AND b_id = b.rowid
 ORDER BY freq;
 """
 
+QUERY_BIGRAM_MANY_SQL = """
+SELECT ikey, e1, e2, bfreq AS freq FROM %(prefix)s_bigram b , %(prefix)s_kb kb, %(prefix)s_keys k
+WHERE ikey IN (%%s) AND k.id = k_id AND b_id = b.rowid
+ORDER BY ikey, freq;
+"""
+
 QUERY_BIGRAM_BY_ENTRY_SQL = """
 SELECT e2, bfreq FROM %(prefix)s_bigram WHERE e1 = :e1;
 """
@@ -222,8 +319,65 @@ ADD_KEYWORD_SQL = """
 INSERT INTO %(prefix)s_keywords VALUES (:keyword);
 """
 
-ADD_KU_SQL = """
-INSERT INTO %(prefix)s_ku VALUES (:k_id, :u_id);
+CREATE_ENTRY_INDEX_SQL = """
+CREATE UNIQUE INDEX IF NOT EXISTS %(prefix)s_entry_idx
+ON %(prefix)s_unigram (p_id, okey);
+"""
+
+DROP_ENTRY_INDEX_SQL = """
+DROP INDEX IF EXISTS %(prefix)s_entry_idx;
+"""
+
+UNIGRAM_EMPTY_SQL = """
+SELECT NOT EXISTS (SELECT 1 FROM %(prefix)s_unigram);
+"""
+
+QUERY_MAX_UNIGRAM_ID_SQL = """
+SELECT IFNULL(MAX(id), 0) FROM %(prefix)s_unigram;
+"""
+
+BULK_GROUP_UNIGRAMS_SQL = """
+CREATE TEMP TABLE bulk_unigrams AS
+SELECT p.id AS p_id, b.okey AS okey, SUM(b.freq) AS freq, MIN(b.rowid) AS ord, NULL AS u_id
+FROM temp.bulk_phrases b, phrases p WHERE p.phrase = b.phrase
+GROUP BY p.id, b.okey;
+"""
+
+BULK_MATCH_UNIGRAMS_SQL = """
+UPDATE temp.bulk_unigrams SET u_id = (
+    SELECT id FROM %(prefix)s_unigram u
+    WHERE u.p_id = bulk_unigrams.p_id AND u.okey = bulk_unigrams.okey);
+"""
+
+BULK_INC_SFREQ_SQL = """
+UPDATE %(prefix)s_unigram
+SET sfreq = sfreq + (SELECT freq FROM temp.bulk_unigrams b WHERE b.u_id = %(prefix)s_unigram.id)
+WHERE id IN (SELECT u_id FROM temp.bulk_unigrams WHERE freq > 0);
+"""
+
+BULK_ADD_UNIGRAMS_SQL = """
+INSERT INTO %(prefix)s_unigram (p_id, okey, sfreq, ufreq)
+SELECT p_id, okey, freq, 0 FROM temp.bulk_unigrams WHERE u_id IS NULL ORDER BY ord;
+"""
+
+QUERY_NEW_UNIGRAMS_SQL = """
+SELECT phrase, okey FROM %(prefix)s_unigram u, phrases p
+WHERE u.id > :id AND p_id = p.id ORDER BY u.id;
+"""
+
+QUERY_NEW_OKEYS_SQL = """
+SELECT DISTINCT okey FROM %(prefix)s_unigram WHERE id > :id;
+"""
+
+BULK_ADD_KEYS_SQL = """
+INSERT OR IGNORE INTO %(prefix)s_keys (ikey) SELECT ikey FROM temp.bulk_keys ORDER BY rowid;
+"""
+
+BULK_ADD_KU_SQL = """
+INSERT OR IGNORE INTO %(prefix)s_ku
+SELECT k.id, u.id FROM %(prefix)s_unigram u, temp.bulk_keys b, %(prefix)s_keys k
+WHERE u.id > :id AND b.okey = u.okey AND k.ikey = b.ikey
+ORDER BY k.id, u.id;
 """
 
 QUERY_USER_FREQ_SQL = """
@@ -240,10 +394,193 @@ FROM %(prefix)s_bigram b,
 WHERE e1 = u1.id AND e2 = u2.id AND bfreq > 0
 """
 
+QUERY_COMPILE_SQL = """
+SELECT ikey, phrase, okey, u.id, sfreq
+FROM %(prefix)s_unigram u, %(prefix)s_ku ku, %(prefix)s_keys k, phrases p
+WHERE k.id = k_id AND u_id = u.id AND p_id = p.id;
+"""
+
+QUERY_UFREQ_SQL = """
+SELECT id, ufreq FROM %(prefix)s_unigram WHERE ufreq > 0;
+"""
+
 UPDATE_USER_FREQ_SQL = """
 UPDATE OR IGNORE %(prefix)s_unigram SET ufreq = ufreq + :freq
 WHERE p_id IN (SELECT id FROM phrases WHERE phrase = :phrase) AND okey = :okey;
 """
+# 用戶詞典：詞條以系統詞典中的unigram id為鍵，並記下詞條文字，以便系統詞典重裝後重新對應
+
+CREATE_USER_DICT_SQL = """
+CREATE TABLE IF NOT EXISTS %(prefix)s_userstats (
+    ufreq INTEGER,
+    stamp TEXT
+);
+INSERT INTO %(prefix)s_userstats
+SELECT 0, NULL WHERE NOT EXISTS (SELECT 1 FROM %(prefix)s_userstats);
+
+CREATE TABLE IF NOT EXISTS %(prefix)s_userfreq (
+    u_id INTEGER PRIMARY KEY,
+    phrase TEXT,
+    okey TEXT,
+    ufreq INTEGER
+);
+CREATE UNIQUE INDEX IF NOT EXISTS %(prefix)s_userfreq_idx
+ON %(prefix)s_userfreq (phrase, okey);
+
+CREATE TABLE IF NOT EXISTS %(prefix)s_userkeys (
+    id INTEGER PRIMARY KEY,
+    ikey TEXT UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS %(prefix)s_bigram (
+    e1 INTEGER,
+    e2 INTEGER,
+    bfreq INTEGER,
+    PRIMARY KEY (e1, e2)
+);
+
+CREATE TABLE IF NOT EXISTS %(prefix)s_kb (
+    k_id INTEGER,
+    b_id INTEGER,
+    PRIMARY KEY (k_id, b_id)
+);
+"""
+
+QUERY_USER_STAMP_SQL = """
+SELECT stamp FROM main.%(prefix)s_userstats;
+"""
+
+UPDATE_USER_STAMP_SQL = """
+UPDATE main.%(prefix)s_userstats SET stamp = :stamp;
+"""
+
+# 先將id取負值，避免更新主鍵時互相衝突；系統詞典中已不存在的詞條一併刪除
+REMAP_USER_DICT_SQL = """
+CREATE TEMP TABLE %(prefix)s_remap (
+    old_id INTEGER PRIMARY KEY,
+    new_id INTEGER
+);
+INSERT INTO temp.%(prefix)s_remap
+SELECT uf.u_id, u.id FROM main.%(prefix)s_userfreq uf
+LEFT JOIN sys.phrases p ON p.phrase = uf.phrase
+LEFT JOIN sys.%(prefix)s_unigram u ON u.p_id = p.id AND u.okey = uf.okey;
+DELETE FROM temp.%(prefix)s_remap WHERE new_id IS NULL;
+
+DELETE FROM main.%(prefix)s_kb WHERE b_id IN (
+    SELECT rowid FROM main.%(prefix)s_bigram
+    WHERE e1 NOT IN (SELECT old_id FROM temp.%(prefix)s_remap)
+       OR e2 NOT IN (SELECT old_id FROM temp.%(prefix)s_remap));
+DELETE FROM main.%(prefix)s_bigram
+WHERE e1 NOT IN (SELECT old_id FROM temp.%(prefix)s_remap)
+   OR e2 NOT IN (SELECT old_id FROM temp.%(prefix)s_remap);
+DELETE FROM main.%(prefix)s_userfreq
+WHERE u_id NOT IN (SELECT old_id FROM temp.%(prefix)s_remap);
+
+UPDATE main.%(prefix)s_bigram SET e1 = -e1, e2 = -e2;
+UPDATE main.%(prefix)s_bigram
+SET e1 = (SELECT new_id FROM temp.%(prefix)s_remap WHERE old_id = -e1),
+    e2 = (SELECT new_id FROM temp.%(prefix)s_remap WHERE old_id = -e2);
+UPDATE main.%(prefix)s_userfreq SET u_id = -u_id;
+UPDATE main.%(prefix)s_userfreq
+SET u_id = (SELECT new_id FROM temp.%(prefix)s_remap WHERE old_id = -u_id);
+
+DROP TABLE temp.%(prefix)s_remap;
+"""
+
+QUERY_SPLIT_STATS_SQL = """
+SELECT s.sfreq + s.ufreq + us.ufreq AS freq, s.ufreq
+FROM sys.%(prefix)s_stats s, main.%(prefix)s_userstats us;
+"""
+
+UPDATE_USER_UFREQ_TOTAL_SQL = """
+UPDATE main.%(prefix)s_userstats SET ufreq = ufreq + :n;
+"""
+
+QUERY_SPLIT_UNIGRAM_SQL = """
+SELECT p.phrase, u.okey, u.id, sfreq + IFNULL(uf.ufreq, 0) AS freq, IFNULL(uf.ufreq, 0)
+FROM sys.%(prefix)s_keys k
+JOIN sys.%(prefix)s_ku ku ON k.id = ku.k_id
+JOIN sys.%(prefix)s_unigram u ON ku.u_id = u.id
+JOIN sys.phrases p ON u.p_id = p.id
+LEFT JOIN main.%(prefix)s_userfreq uf ON uf.u_id = u.id
+WHERE ikey = :ikey
+ORDER BY freq DESC, u.id;
+"""
+
+QUERY_SPLIT_UNIGRAM_MANY_SQL = """
+SELECT ikey, p.phrase, u.okey, u.id, sfreq + IFNULL(uf.ufreq, 0) AS freq, IFNULL(uf.ufreq, 0)
+FROM sys.%(prefix)s_keys k
+JOIN sys.%(prefix)s_ku ku ON k.id = ku.k_id
+JOIN sys.%(prefix)s_unigram u ON ku.u_id = u.id
+JOIN sys.phrases p ON u.p_id = p.id
+LEFT JOIN main.%(prefix)s_userfreq uf ON uf.u_id = u.id
+WHERE ikey IN (%%s)
+ORDER BY ikey, freq DESC, u.id;
+"""
+
+QUERY_SPLIT_UNIGRAM_INDEX_SQL = """
+SELECT ikey, p.phrase, u.okey, u.id, sfreq + IFNULL(uf.ufreq, 0) AS freq, IFNULL(uf.ufreq, 0)
+FROM sys.%(prefix)s_keys k
+JOIN sys.%(prefix)s_ku ku ON k.id = ku.k_id
+JOIN sys.%(prefix)s_unigram u ON ku.u_id = u.id
+JOIN sys.phrases p ON u.p_id = p.id
+LEFT JOIN main.%(prefix)s_userfreq uf ON uf.u_id = u.id;
+"""
+
+ADD_USER_ENTRY_SQL = """
+INSERT OR IGNORE INTO main.%(prefix)s_userfreq VALUES (:id, :phrase, :okey, 0);
+"""
+
+INC_USER_UFREQ_SQL = """
+UPDATE main.%(prefix)s_userfreq SET ufreq = ufreq + :freq WHERE u_id = :id;
+"""
+
+QUERY_USER_KEY_SQL = """
+SELECT id FROM main.%(prefix)s_userkeys WHERE ikey = :ikey;
+"""
+
+ADD_USER_KEY_SQL = """
+INSERT INTO main.%(prefix)s_userkeys VALUES (NULL, :ikey);
+"""
+
+QUERY_SPLIT_BIGRAM_SQL = """
+SELECT e1, e2, bfreq AS freq FROM main.%(prefix)s_bigram b , main.%(prefix)s_kb kb, main.%(prefix)s_userkeys k
+WHERE ikey = :ikey AND k.id = k_id AND b_id = b.rowid
+ORDER BY freq;
+"""
+
+QUERY_SPLIT_BIGRAM_MANY_SQL = """
+SELECT ikey, e1, e2, bfreq AS freq FROM main.%(prefix)s_bigram b , main.%(prefix)s_kb kb, main.%(prefix)s_userkeys k
+WHERE ikey IN (%%s) AND k.id = k_id AND b_id = b.rowid
+ORDER BY ikey, freq;
+"""
+
+QUERY_SPLIT_USER_FREQ_SQL = """
+SELECT phrase, ufreq, okey FROM main.%(prefix)s_userfreq
+WHERE ufreq > 0
+"""
+
+QUERY_SPLIT_USER_GRAM_SQL = """
+SELECT u1.phrase, u2.phrase, bfreq, u1.okey, u2.okey
+FROM main.%(prefix)s_bigram b, main.%(prefix)s_userfreq u1, main.%(prefix)s_userfreq u2
+WHERE e1 = u1.u_id AND e2 = u2.u_id AND bfreq > 0
+"""
+
+ADD_USER_FREQ_SQL = """
+INSERT OR IGNORE INTO main.%(prefix)s_userfreq
+SELECT u.id, p.phrase, u.okey, 0 FROM sys.phrases p, sys.%(prefix)s_unigram u
+WHERE p.phrase = :phrase AND u.p_id = p.id AND u.okey = :okey;
+"""
+
+QUERY_USER_UFREQ_SQL = """
+SELECT u_id, ufreq FROM main.%(prefix)s_userfreq WHERE ufreq > 0;
+"""
+
+UPDATE_SPLIT_USER_FREQ_SQL = """
+UPDATE main.%(prefix)s_userfreq SET ufreq = ufreq + :freq
+WHERE phrase = :phrase AND okey = :okey;
+"""
+
 
 def _generate_dict_specific_sql(db, prefix_args):
     db._create_dict_sql = CREATE_DICT_SQL % prefix_args
@@ -256,12 +593,24 @@ def _generate_dict_specific_sql(db, prefix_args):
     db._update_ufreq_total_sql = UPDATE_UFREQ_TOTAL_SQL % prefix_args
     db._update_sfreq_total_sql = UPDATE_SFREQ_TOTAL_SQL % prefix_args
     db._query_unigram_sql = QUERY_UNIGRAM_SQL % prefix_args
+    db._query_unigram_index_sql = QUERY_UNIGRAM_INDEX_SQL % prefix_args
+    db._query_unigram_many_sql = QUERY_UNIGRAM_MANY_SQL % prefix_args
     db._unigram_exist_sql = UNIGRAM_EXIST_SQL % prefix_args
-    db._add_unigram_sql = ADD_UNIGRAM_SQL % prefix_args
-    db._inc_sfreq_sql = INC_SFREQ_SQL % prefix_args
     db._inc_ufreq_sql = INC_UFREQ_SQL % prefix_args
-    db._add_ku_sql = ADD_KU_SQL % prefix_args
+    db._create_entry_index_sql = CREATE_ENTRY_INDEX_SQL % prefix_args
+    db._drop_entry_index_sql = DROP_ENTRY_INDEX_SQL % prefix_args
+    db._unigram_empty_sql = UNIGRAM_EMPTY_SQL % prefix_args
+    db._query_max_unigram_id_sql = QUERY_MAX_UNIGRAM_ID_SQL % prefix_args
+    db._bulk_group_unigrams_sql = BULK_GROUP_UNIGRAMS_SQL % prefix_args
+    db._bulk_match_unigrams_sql = BULK_MATCH_UNIGRAMS_SQL % prefix_args
+    db._bulk_inc_sfreq_sql = BULK_INC_SFREQ_SQL % prefix_args
+    db._bulk_add_unigrams_sql = BULK_ADD_UNIGRAMS_SQL % prefix_args
+    db._query_new_unigrams_sql = QUERY_NEW_UNIGRAMS_SQL % prefix_args
+    db._query_new_okeys_sql = QUERY_NEW_OKEYS_SQL % prefix_args
+    db._bulk_add_keys_sql = BULK_ADD_KEYS_SQL % prefix_args
+    db._bulk_add_ku_sql = BULK_ADD_KU_SQL % prefix_args
     db._query_bigram_sql = QUERY_BIGRAM_SQL % prefix_args
+    db._query_bigram_many_sql = QUERY_BIGRAM_MANY_SQL % prefix_args
     db._query_bigram_by_entry_sql = QUERY_BIGRAM_BY_ENTRY_SQL % prefix_args
     db._bigram_exist_sql = BIGRAM_EXIST_SQL % prefix_args
     db._add_bigram_sql = ADD_BIGRAM_SQL % prefix_args
@@ -271,67 +620,800 @@ def _generate_dict_specific_sql(db, prefix_args):
     db._query_user_freq_sql = QUERY_USER_FREQ_SQL % prefix_args
     db._query_user_gram_sql = QUERY_USER_GRAM_SQL % prefix_args
     db._update_user_freq_sql = UPDATE_USER_FREQ_SQL % prefix_args
+    db._query_compile_sql = QUERY_COMPILE_SQL % prefix_args
+    db._query_ufreq_sql = QUERY_UFREQ_SQL % prefix_args
+    # 以下幾項在分離系統詞典時改寫
+    db._query_bigram_key_sql = db._query_key_sql
+    db._add_bigram_key_sql = db._add_key_sql
+    db._add_user_entry_sql = None
+    db._add_user_freq_sql = None
+
+
+def _generate_user_dict_sql(db, prefix_args):
+    db._create_user_dict_sql = CREATE_USER_DICT_SQL % prefix_args
+    db._query_user_stamp_sql = QUERY_USER_STAMP_SQL % prefix_args
+    db._update_user_stamp_sql = UPDATE_USER_STAMP_SQL % prefix_args
+    db._remap_user_dict_sql = REMAP_USER_DICT_SQL % prefix_args
+    db._query_stats_sql = QUERY_SPLIT_STATS_SQL % prefix_args
+    db._update_ufreq_total_sql = UPDATE_USER_UFREQ_TOTAL_SQL % prefix_args
+    db._query_unigram_sql = QUERY_SPLIT_UNIGRAM_SQL % prefix_args
+    db._query_unigram_index_sql = QUERY_SPLIT_UNIGRAM_INDEX_SQL % prefix_args
+    db._query_unigram_many_sql = QUERY_SPLIT_UNIGRAM_MANY_SQL % prefix_args
+    db._add_user_entry_sql = ADD_USER_ENTRY_SQL % prefix_args
+    db._inc_ufreq_sql = INC_USER_UFREQ_SQL % prefix_args
+    db._query_bigram_key_sql = QUERY_USER_KEY_SQL % prefix_args
+    db._add_bigram_key_sql = ADD_USER_KEY_SQL % prefix_args
+    db._query_bigram_sql = QUERY_SPLIT_BIGRAM_SQL % prefix_args
+    db._query_bigram_many_sql = QUERY_SPLIT_BIGRAM_MANY_SQL % prefix_args
+    db._query_user_freq_sql = QUERY_SPLIT_USER_FREQ_SQL % prefix_args
+    db._query_user_gram_sql = QUERY_SPLIT_USER_GRAM_SQL % prefix_args
+    db._add_user_freq_sql = ADD_USER_FREQ_SQL % prefix_args
+    db._update_user_freq_sql = UPDATE_SPLIT_USER_FREQ_SQL % prefix_args
+    db._query_ufreq_sql = QUERY_USER_UFREQ_SQL % prefix_args
+
+
+class UnigramIndex:
+
+    '''編碼到詞條的內存索引
+
+    一次讀入某詞典的全部unigram，按ikey分組，組內按詞頻降序排好
+    查詢時不再執行QUERY_UNIGRAM_SQL；用戶詞頻的變化直接合併到索引中
+
+    '''
+
+    def __init__(self, rows, stats):
+        # ikey => [(phrase, okey, eid, freq, ufreq), ...]
+        self.__postings = dict()
+        # eid => [ikey, ...]
+        self.__ikeys = dict()
+        entries = dict()
+        for (ikey, phrase, okey, eid, freq, ufreq) in rows:
+            # 同一詞條在各ikey下共用一個tuple
+            if eid in entries:
+                x = entries[eid]
+            else:
+                x = entries[eid] = (phrase, okey, eid, freq, ufreq)
+            if ikey in self.__postings:
+                self.__postings[ikey].append(x)
+            else:
+                self.__postings[ikey] = [x]
+            if eid in self.__ikeys:
+                self.__ikeys[eid].append(ikey)
+            else:
+                self.__ikeys[eid] = [ikey]
+        for p in self.__postings.itervalues():
+            p.sort(key=UnigramIndex.__order)
+        self.__stats = tuple(stats)
+
+    @staticmethod
+    def __order(x):
+        return (-x[3], x[2])
+
+    def lookup(self, ikey, limit):
+        p = self.__postings.get(ikey)
+        return p[:limit] if p else []
+
+    def lookup_stats(self):
+        return self.__stats
+
+    def update_stats(self, n):
+        freq, ufreq = self.__stats
+        self.__stats = (freq + n, ufreq)
+
+    def update_freq(self, eid, n):
+        '''累加詞條的用戶詞頻，並維持各posting list的次序
+
+        可能由Learner線程調用，故替換整個列表而不在原處修改
+
+        '''
+        ikeys = self.__ikeys.get(eid)
+        if not ikeys:
+            return
+        p = self.__postings[ikeys[0]]
+        for x in p:
+            if x[2] == eid:
+                break
+        y = (x[0], x[1], eid, x[3] + n, x[4] + n)
+        for ikey in ikeys:
+            p = list(self.__postings[ikey])
+            i = p.index(x)
+            p[i] = y
+            # 詞頻只增不減，向前挪到合適的位置即可
+            while i > 0 and UnigramIndex.__order(p[i - 1]) > UnigramIndex.__order(y):
+                p[i - 1], p[i] = y, p[i - 1]
+                i -= 1
+            self.__postings[ikey] = p
+
+
+class CompiledDict:
+
+    '''編譯成二進制文件的系統詞典，以mmap映射到內存
+
+    文件由zimedb-admin.py --compile生成，各進程經由操作系統的頁面緩存共享同一份數據
+    ikey按UTF-8字節序排列，查詢時二分查找；每個ikey的詞條按系統詞頻降序排好
+    用戶詞頻不在文件中，載入後疊加在查詢結果上
+
+    文件結構，整數均為小端序uint32：
+        文件頭   MAGIC, VERSION, 各段的長度及位置，其後為DictStamp
+        ikey     偏移表 + 字符串池
+        posting  每個ikey的起止位置 + 詞條 (eid, sfreq, phrase起止, okey起止)
+        phrase   字符串池
+        okey     字符串池
+
+    '''
+
+    MAGIC = 'ZIMEDICT'
+    VERSION = 1
+    HEADER = struct.Struct('<8s10I')
+    ENTRY_FIELDS = 6
+
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            self.__mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        h = CompiledDict.HEADER.unpack_from(self.__mm, 0)
+        if h[0] != CompiledDict.MAGIC or h[1] != CompiledDict.VERSION:
+            self.__mm.close()
+            raise ValueError('invalid compiled dict: %s' % path)
+        (stamp_len, self.__n_keys, n_entries,
+         self.__key_offsets, self.__key_pool, self.__posting_index, self.__postings,
+         self.__phrase_pool, self.__okey_pool) = h[2:]
+        start = CompiledDict.HEADER.size
+        self.stamp = self.__mm[start:start + stamp_len].decode('utf-8')
+        # eid => ufreq
+        self.__user_freq = dict()
+
+    def close(self):
+        self.__mm.close()
+
+    def load_user_freq(self, rows):
+        self.__user_freq = dict(rows)
+
+    def update_freq(self, eid, n):
+        self.__user_freq[eid] = self.__user_freq.get(eid, 0) + n
+
+    def lookup(self, ikey, limit):
+        '''返回 [(phrase, okey, eid, freq, ufreq), ...]，與QUERY_UNIGRAM_SQL次序相同'''
+        mm = self.__mm
+        unpack_from = struct.unpack_from
+        i = self.__find(ikey.encode('utf-8'))
+        if i is None:
+            return []
+        start, end = unpack_from('<2I', mm, self.__posting_index + 4 * i)
+        w = CompiledDict.ENTRY_FIELDS
+        n = end - start
+        t = unpack_from('<%dI' % (w * n), mm, self.__postings + 4 * w * start)
+        user_freq = self.__user_freq
+        # 多數詞條沒有用戶詞頻，先在C層面求交集
+        boosted = user_freq and user_freq.viewkeys() & set(t[0::w])
+        if boosted:
+            picked = []
+            for j in xrange(0, w * n, w):
+                eid = t[j]
+                if eid in boosted:
+                    ufreq = user_freq[eid]
+                    picked.append((-(t[j + 1] + ufreq), eid, j, ufreq))
+                elif j < w * (limit + len(boosted)):
+                    picked.append((-t[j + 1], eid, j, 0))
+            picked.sort()
+            del picked[limit:]
+        else:
+            picked = [(-t[j + 1], t[j], j, 0) for j in xrange(0, w * min(n, limit), w)]
+        p, o = self.__phrase_pool, self.__okey_pool
+        return [(unicode(mm[p + t[j + 2]:p + t[j + 3]], 'utf-8'),
+                 unicode(mm[o + t[j + 4]:o + t[j + 5]], 'utf-8'),
+                 eid, -neg_freq, ufreq)
+                for (neg_freq, eid, j, ufreq) in picked]
+
+    def __find(self, key):
+        mm = self.__mm
+        unpack_from = struct.unpack_from
+        offsets, pool = self.__key_offsets, self.__key_pool
+        lo, hi = 0, self.__n_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            a, b = unpack_from('<2I', mm, offsets + 4 * mid)
+            if mm[pool + a:pool + b] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.__n_keys:
+            a, b = unpack_from('<2I', mm, offsets + 4 * lo)
+            if mm[pool + a:pool + b] == key:
+                return lo
+        return None
+
+    @staticmethod
+    def build(path, rows, stamp):
+        '''由 (ikey, phrase, okey, eid, sfreq) 生成詞典文件'''
+        def pool(strings, x):
+            # 相同的字符串只存一份，返回其在池中的起止位置
+            if x not in strings[0]:
+                data = x.encode('utf-8')
+                strings[0][x] = (strings[1], strings[1] + len(data))
+                strings[1] += len(data)
+                strings[2].append(data)
+            return strings[0][x]
+        phrases = [dict(), 0, []]
+        okeys = [dict(), 0, []]
+        postings = dict()
+        for (ikey, phrase, okey, eid, sfreq) in rows:
+            pa, pb = pool(phrases, phrase)
+            oa, ob = pool(okeys, okey)
+            postings.setdefault(ikey.encode('utf-8'), []).append((-sfreq, eid, pa, pb, oa, ob))
+        keys = sorted(postings)
+        key_offsets = [0]
+        posting_index = [0]
+        entries = []
+        for k in keys:
+            key_offsets.append(key_offsets[-1] + len(k))
+            for (neg_freq, eid, pa, pb, oa, ob) in sorted(postings[k]):
+                entries.extend((eid, -neg_freq, pa, pb, oa, ob))
+            posting_index.append(len(entries) // CompiledDict.ENTRY_FIELDS)
+        pack = lambda a: struct.pack('<%dI' % len(a), *a)
+        stamp = stamp.encode('utf-8')
+        sections = [pack(key_offsets), ''.join(keys),
+                    pack(posting_index), pack(entries),
+                    ''.join(phrases[2]), ''.join(okeys[2])]
+        positions = []
+        pos = CompiledDict.HEADER.size + len(stamp)
+        for x in sections:
+            positions.append(pos)
+            pos += len(x)
+        header = CompiledDict.HEADER.pack(CompiledDict.MAGIC, CompiledDict.VERSION,
+                                          len(stamp), len(keys),
+                                          len(entries) // CompiledDict.ENTRY_FIELDS,
+                                          *positions)
+        # 先寫入臨時文件再改名，以免正在映射該文件的進程讀到半成品
+        temp_path = path + '.tmp'
+        f = open(temp_path, 'wb')
+        try:
+            f.write(header)
+            f.write(stamp)
+            for x in sections:
+                f.write(x)
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+
+
+class LookupCache:
+
+    '''查詢結果的LRU緩存
+
+    進程內所有DB對象共用，不隨ContextInfo的重建而失效
+    每條緩存記錄登記其結果所涉及的詞條，詞頻變化時據此精確地清除
+
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.__lock = threading.Lock()
+        # key => (result, refs)
+        self.__items = OrderedDict()
+        # ref => set of keys
+        self.__refs = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # 每次清除記錄時遞增；查詢前取得的值用於判斷結果是否已經過時
+        self.generation = 0
+
+    def get(self, key):
+        with self.__lock:
+            if key not in self.__items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            x = self.__items.pop(key)
+            self.__items[key] = x
+            return x[0]
+
+    def put(self, key, result, refs, generation=None):
+        if self.capacity <= 0:
+            return
+        with self.__lock:
+            if generation is not None and generation != self.generation:
+                # 查詢期間有寫入，結果可能已過時
+                return
+            if key in self.__items:
+                self.__remove(key)
+            self.__items[key] = (result, refs)
+            for r in refs:
+                if r in self.__refs:
+                    self.__refs[r].add(key)
+                else:
+                    self.__refs[r] = set([key])
+            while len(self.__items) > self.capacity:
+                self.__remove(next(iter(self.__items)))
+                self.evictions += 1
+
+    def invalidate(self, ref):
+        with self.__lock:
+            self.generation += 1
+            if ref in self.__refs:
+                for key in list(self.__refs[ref]):
+                    self.__remove(key)
+
+    def invalidate_keys(self, keys):
+        with self.__lock:
+            self.generation += 1
+            for key in keys:
+                if key in self.__items:
+                    self.__remove(key)
+
+    def invalidate_prefix(self, prefix):
+        with self.__lock:
+            self.generation += 1
+            for key in [k for k in self.__items if k[1] == prefix]:
+                self.__remove(key)
+
+    def __remove(self, key):
+        result, refs = self.__items.pop(key)
+        for r in refs:
+            s = self.__refs.get(r)
+            if s is not None:
+                s.discard(key)
+                if not s:
+                    del self.__refs[r]
+
+    def stats(self):
+        return {'size': len(self.__items),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class ConnectionPool:
+
+    '''數據庫連接池
+
+    每個線程各持有一個只讀連接；所有寫操作經由唯一的寫連接，以鎖串行化
+    寫連接上有未提交的修改時，查詢也經由寫連接，以便看到這些修改
+    指定system_db_file時，每個連接都以不可變模式附加該文件為 sys
+
+    '''
+
+    def __init__(self, db_file, system_db_file=None):
+        self.db_file = db_file
+        self.__pragmas = []
+        # 每次更改連接參數時遞增；各線程的只讀連接據此補上新的參數
+        self.__pragmas_version = 0
+        # 內存數據庫無法被多個連接共享
+        self.__shared = db_file == ':memory:'
+        self.__local = threading.local()
+        self.__lock = threading.RLock()
+        self.__writer = sqlite3.connect(db_file, check_same_thread=False)
+        self.__dirty = False
+        self.__system_db = None
+        if system_db_file:
+            self.__system_db = ConnectionPool.__immutable_uri(system_db_file)
+            self.__attach(self.__writer)
+            if not ConnectionPool.__attached_file(self.__writer, system_db_file):
+                # SQLite未啟用URI文件名時，退而以普通路徑附加
+                debug('uri filenames not supported; attaching system db as is.')
+                self.__writer.execute('DETACH DATABASE sys;')
+                self.__system_db = system_db_file
+                self.__attach(self.__writer)
+
+    @staticmethod
+    def __immutable_uri(path):
+        return 'file:%s?immutable=1' % urllib.pathname2url(os.path.abspath(path))
+
+    @staticmethod
+    def __attached_file(conn, path):
+        for seq, name, f in conn.execute('PRAGMA database_list;'):
+            if name == 'sys':
+                return os.path.abspath(f) == os.path.abspath(path)
+        return False
+
+    def __attach(self, conn):
+        if self.__system_db:
+            conn.execute('ATTACH DATABASE ? AS sys;', (self.__system_db,))
+
+    def set_pragmas(self, pragmas):
+        '''更改連接參數；已打開的只讀連接在各自的線程中下次使用時更新'''
+        with self.__lock:
+            self.__pragmas = pragmas
+            self.__pragmas_version += 1
+            DB.apply_pragmas(self.__writer, pragmas)
+
+    def reader(self):
+        '''當前線程的只讀連接'''
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = self.__local.conn = sqlite3.connect(self.db_file)
+            self.__local.version = None
+            self.__attach(conn)
+        if self.__local.version != self.__pragmas_version:
+            self.__local.version = self.__pragmas_version
+            DB.apply_pragmas(conn, self.__pragmas + [u'query_only = ON'])
+        return conn
+
+    def query(self, sql, args=(), limit=None):
+        if not Profiler.enabled:
+            return self.__query(sql, args, limit)
+        start = time.time()
+        try:
+            return self.__query(sql, args, limit)
+        finally:
+            Profiler.add_sql(time.time() - start)
+
+    def __query(self, sql, args, limit):
+        if self.__dirty or self.__shared:
+            with self.__lock:
+                cur = self.__writer.execute(sql, args)
+                return cur.fetchall() if limit is None else cur.fetchmany(limit)
+        cur = self.reader().execute(sql, args)
+        return cur.fetchall() if limit is None else cur.fetchmany(limit)
+
+    @contextmanager
+    def writer(self, dirty=True):
+        '''取得寫連接；dirty為False表示在釋放前會自行提交'''
+        with self.__lock:
+            if dirty:
+                self.__dirty = True
+            yield self.__writer
+
+    def commit(self):
+        with self.__lock:
+            self.__writer.commit()
+            self.__dirty = False
+
+    def rollback(self):
+        with self.__lock:
+            self.__writer.rollback()
+            self.__dirty = False
+
+    def close(self):
+        '''關閉寫連接及當前線程的只讀連接'''
+        conn = getattr(self.__local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.__local.conn = None
+        with self.__lock:
+            self.__writer.close()
+
+
+class Learner(threading.Thread):
+
+    '''後台寫入用戶詞頻
+
+    經由連接池的寫連接，將排隊的更新操作分批在事務中執行
+    隊列中的每一項為 (write, learn)：write(cursor) 寫入數據庫，learn() 在提交後更新內存中的索引和緩存
+
+    '''
+
+    BATCH_SIZE = 100
+    # 數據庫被鎖定時的重試次數及間隔（秒）
+    RETRIES = 3
+    RETRY_DELAY = 1.0
+
+    def __init__(self, pool):
+        super(Learner, self).__init__(name='zime-learner')
+        self.daemon = True
+        self.__pool = pool
+        self.__queue = Queue.Queue()
+
+    def submit(self, updates):
+        for x in updates:
+            self.__queue.put(x)
+
+    def sync(self):
+        '''等待隊列中的更新全部寫入'''
+        self.__queue.join()
+
+    def run(self):
+        while True:
+            batch = [self.__queue.get()]
+            try:
+                while len(batch) < Learner.BATCH_SIZE:
+                    batch.append(self.__queue.get_nowait())
+            except Queue.Empty:
+                pass
+            try:
+                self.__process(batch)
+            except Exception, e:
+                # 線程不可因個別更新出錯而退出，否則此後的學習全部丟失，sync()亦永不返回
+                debug('learner: unexpected error:', e)
+            finally:
+                for x in batch:
+                    self.__queue.task_done()
+
+    def __process(self, batch):
+        try:
+            self.__write(batch)
+        except sqlite3.OperationalError, e:
+            # 重試後仍被鎖定
+            debug('learner: %d updates dropped:' % len(batch), e)
+            return
+        except Exception, e:
+            if len(batch) == 1:
+                debug('learner: update dropped:', e)
+                return
+            # 整批寫入失敗時逐項重寫，只捨棄出錯的更新
+            debug('learner: batch failed, writing one by one:', e)
+            for x in batch:
+                self.__process([x])
+            return
+        for write, learn in batch:
+            try:
+                learn()
+            except Exception, e:
+                debug('learner: error updating index:', e)
+
+    def __write(self, batch):
+        '''在一個事務中寫入一批更新；數據庫被鎖定時稍後重試'''
+        retries = 0
+        while True:
+            try:
+                with self.__pool.writer(dirty=False) as conn:
+                    # 寫連接上尚未提交的修改先行提交，出錯時回滾的只是本批的寫入
+                    self.__pool.commit()
+                    try:
+                        cur = conn.cursor()
+                        for write, learn in batch:
+                            write(cur)
+                        self.__pool.commit()
+                    except:
+                        # 在持有寫鎖時回滾，以免波及其他線程隨後的寫入
+                        self.__pool.rollback()
+                        raise
+                return
+            except sqlite3.OperationalError, e:
+                if retries >= Learner.RETRIES:
+                    raise
+                retries += 1
+                debug('learner: retrying:', e)
+                time.sleep(Learner.RETRY_DELAY * retries)
 
 
 class DB:
 
     UNIG_LIMIT = 1000
     BIG_LIMIT = 50
+    # SQLITE_MAX_VARIABLE_NUMBER defaults to 999
+    MANY_LIMIT = 500
+
+    # 連接參數，以設定值Option/DBProfile選用，Option/DBPragma可追加多項
+    PROFILES = {
+        u'legacy': [],
+        u'wal': [
+            u'journal_mode = WAL',
+            u'synchronous = NORMAL',
+            u'mmap_size = 67108864',
+            u'cache_size = -8192',
+            u'temp_store = MEMORY',
+        ],
+    }
+    DEFAULT_PROFILE = u'wal'
+    # 批量導入詞條期間的連接參數
+    BULK_PRAGMAS = [
+        u'synchronous = OFF',
+        u'cache_size = -65536',
+        u'temp_store = MEMORY',
+    ]
 
     FLUSH_INTERVAL = 2 * 60  # 2 minutes
     __last_flush_time = 0
-    __conn = None
+    __pool = None
+    __learner = None
+    # dict prefix => UnigramIndex
+    __unigram_indices = dict()
+    # dict prefix => CompiledDict，無可用的編譯詞典時為None
+    __compiled_dicts = dict()
+    __db_dir = None
+    LOOKUP_CACHE_SIZE = 2000
+    # shared by all DB instances; keys are ('u' | 'b', dict prefix, ikey)
+    lookup_cache = LookupCache(LOOKUP_CACHE_SIZE)
+    # 已建立用戶詞典的dict prefix
+    __user_dicts = set()
+    # dict prefix => {屬性名: SQL語句}，按詞典前綴生成，各DB實例共用
+    __dict_sql = dict()
+
+    __query_setting_sql = QUERY_SETTING_SQL
+    __query_setting_items_sql = QUERY_SETTING_ITEMS_SQL
+    __query_schema_list_sql = QUERY_SCHEMA_LIST_SQL
+    __query_dict_prefix_sql = QUERY_DICT_PREFIX_SQL
+    # Option/下的設定值，見read_option
+    __options = dict()
 
     @classmethod
-    def open(cls, db_file, read_only=False):
+    def open(cls, db_file, read_only=False, system_db_file=None):
+        '''打開數據庫
+
+        指定system_db_file時，db_file只存放用戶設定及用戶詞頻，系統詞典以只讀方式附加
+        否則所有數據都在db_file中
+
+        '''
         #debug('opening db file:', db_file)
-        if cls.__conn:
+        if cls.__pool:
             return
-        cls.__conn = sqlite3.connect(db_file)
+        cls.__pool = ConnectionPool(db_file, system_db_file)
         cls.read_only = read_only
+        cls.system_db_file = system_db_file
+        if db_file != ':memory:':
+            cls.__db_dir = os.path.dirname(os.path.abspath(system_db_file or db_file))
+        if system_db_file:
+            cls.__query_setting_sql = QUERY_SPLIT_SETTING_SQL
+            cls.__query_setting_items_sql = QUERY_SPLIT_SETTING_ITEMS_SQL
+            cls.__query_schema_list_sql = QUERY_SPLIT_SCHEMA_LIST_SQL
+            cls.__query_dict_prefix_sql = QUERY_SPLIT_DICT_PREFIX_SQL
         if not read_only:
-            cls.__conn.executescript(INIT_ZIME_DB_SQL)
+            with cls.__pool.writer() as conn:
+                conn.executescript(INIT_USER_DB_SQL if system_db_file else INIT_ZIME_DB_SQL)
             cls.flush(True)
+        cls.__options = cls.read_config(u'Option/')
+        cls.__pool.set_pragmas(cls.__load_profile())
+        cache_size = cls.read_option(u'LookupCacheSize')
+        if cache_size is not None:
+            cls.lookup_cache.capacity = int(cache_size)
+        # 用戶詞頻默認由後台線程寫入；設定Option/WriteBehind = no則在當前線程同步寫入
+        write_behind = cls.read_option(u'WriteBehind') not in (u'no', u'false')
+        if write_behind and not read_only and db_file != ':memory:':
+            cls.__learner = Learner(cls.__pool)
+            cls.__learner.start()
+            atexit.register(cls.sync)
+
+    @classmethod
+    def __load_profile(cls):
+        name = cls.read_option(u'DBProfile') or cls.DEFAULT_PROFILE
+        if name not in cls.PROFILES:
+            debug('unknown db profile:', name)
+            name = cls.DEFAULT_PROFILE
+        return cls.PROFILES[name] + list(cls.__options.get(u'DBPragma', ()))
+
+    @classmethod
+    def read_pragma(cls, name):
+        '''經由當前線程所用的連接讀取連接參數'''
+        r = cls.__pool.query(u'PRAGMA %s;' % name)
+        return r[0][0] if r else None
+
+    @staticmethod
+    def apply_pragmas(conn, pragmas):
+        for x in pragmas:
+            try:
+                conn.execute(u'PRAGMA %s;' % x)
+            except sqlite3.Error, e:
+                debug('error applying pragma:', x, e)
+
+    @classmethod
+    def sync(cls):
+        '''等待後台寫入完成'''
+        if cls.__learner:
+            cls.__learner.sync()
+
+    @classmethod
+    def compiled_dict_path(cls, prefix):
+        '''編譯詞典與系統詞典存放在同一目錄'''
+        if not cls.__db_dir:
+            return None
+        return os.path.join(cls.__db_dir, '%s.dict.bin' % prefix)
+
+    @classmethod
+    def algebra_path(cls, schema):
+        '''拼寫運算結果的緩存文件，亦與系統詞典存放在同一目錄'''
+        if not cls.__db_dir:
+            return None
+        return os.path.join(cls.__db_dir, '%s.algebra.bin' % schema)
+
+    @classmethod
+    def lookup_cache_stats(cls):
+        return cls.lookup_cache.stats()
+
+    @classmethod
+    def __query(cls, sql, args=(), limit=None):
+        return cls.__pool.query(sql, args, limit)
+
+    @classmethod
+    def __query_one(cls, sql, args=()):
+        r = cls.__pool.query(sql, args, 1)
+        return r[0] if r else None
+
+    @classmethod
+    def __writer(cls):
+        return cls.__pool.writer()
+
+    @classmethod
+    @contextmanager
+    def __bulk_transaction(cls):
+        '''在一個事務中完成批量寫入，期間換用BULK_PRAGMAS'''
+        with cls.__pool.writer(dirty=False) as conn:
+            cls.__pool.commit()
+            names = [x.split(u'=')[0].strip() for x in cls.BULK_PRAGMAS]
+            saved = [u'%s = %s' % (x, conn.execute(u'PRAGMA %s;' % x).fetchone()[0]) for x in names]
+            DB.apply_pragmas(conn, cls.BULK_PRAGMAS)
+            # 自行管理事務，以免建表、建索引時被隱式提交
+            conn.isolation_level = None
+            try:
+                conn.execute('BEGIN;')
+                try:
+                    yield conn
+                except:
+                    conn.execute('ROLLBACK;')
+                    raise
+                conn.execute('COMMIT;')
+            finally:
+                conn.isolation_level = ''
+                DB.apply_pragmas(conn, saved)
 
     @classmethod
     def read_setting(cls, key):
-        r = cls.__conn.execute(QUERY_SETTING_SQL, {'path': key}).fetchone()
+        r = cls.__query_one(cls.__query_setting_sql, {'path': key})
         return r[0] if r else None
 
     @classmethod
     def read_setting_list(cls, key):
-        r = cls.__conn.execute(QUERY_SETTING_SQL, {'path': key}).fetchall()
+        r = cls.__query(cls.__query_setting_sql, {'path': key})
         return [x[0] for x in r]
 
     @classmethod
     def read_setting_items(cls, key):
-        r = cls.__conn.execute(QUERY_SETTING_ITEMS_SQL, {'pattern': key + '%'}).fetchall()
+        r = cls.__query(cls.__query_setting_items_sql, {'pattern': key + '%'})
         return [(x[0][len(key):], x[1]) for x in r]
 
+    @classmethod
+    def read_config(cls, section):
+        '''以一次查詢讀入section下的全部設定值，返回 {key: (value, ...)}
+
+        值為tuple，取用者不應修改
+
+        '''
+        config = dict()
+        for (path, value) in cls.__query(cls.__query_setting_items_sql, {'pattern': section + u'%'}):
+            # LIKE不分大小寫，且 _ 為通配符
+            if path.startswith(section):
+                key = path[len(section):]
+                config[key] = config.get(key, ()) + (value,)
+        return config
+
+    @classmethod
+    def read_option(cls, key):
+        '''取Option/下的設定值；讀自快照，寫入設定時更新'''
+        r = cls.__options.get(key)
+        return r[0] if r else None
+
+    @classmethod
+    def __setting_changed(cls, path):
+        if path.startswith(u'Option/'):
+            cls.__options = cls.read_config(u'Option/')
+
     @classmethod
     def add_setting(cls, key, value):
         if cls.read_only:
             return False
-        path_id = cls.__get_or_insert_setting_path(key)
-        args = {'path_id': path_id, 'value': value}
-        cls.__conn.execute(ADD_SETTING_VALUE_SQL, args)
+        with cls.__writer() as conn:
+            path_id = cls.__get_or_insert_setting_path(conn, key)
+            args = {'path_id': path_id, 'value': value}
+            conn.execute(ADD_SETTING_VALUE_SQL, args)
+        cls.__setting_changed(key)
         return True
 
     @classmethod
     def update_setting(cls, key, value):
         if cls.read_only:
             return False
-        path_id = cls.__get_or_insert_setting_path(key)
-        args = {'path_id': path_id, 'value': value}
-        if cls.read_setting(key) is None:
-            cls.__conn.execute(ADD_SETTING_VALUE_SQL, args)
-        else:
-            cls.__conn.execute(UPDATE_SETTING_VALUE_SQL, args)
+        with cls.__writer() as conn:
+            path_id = cls.__get_or_insert_setting_path(conn, key)
+            args = {'path_id': path_id, 'value': value}
+            if cls.read_setting(key) is None:
+                conn.execute(ADD_SETTING_VALUE_SQL, args)
+            else:
+                conn.execute(UPDATE_SETTING_VALUE_SQL, args)
+        cls.__setting_changed(key)
+        if cls.__learner:
+            # 不要長時間持有寫鎖，以免阻塞Learner
+            cls.flush(True)
         return True
 
     @classmethod
-    def __get_or_insert_setting_path(cls, path):
-        cur = cls.__conn.cursor()
+    def __get_or_insert_setting_path(cls, conn, path):
+        cur = conn.cursor()
         args = {'path' : path}
         r = cur.execute(QUERY_SETTING_PATH_SQL, args).fetchone()
         if r:
@@ -342,255 +1424,439 @@ class DB:
 
     @classmethod
     def clear_setting(cls, path):
-        cur = cls.__conn.cursor()
-        cur.execute(CLEAR_SETTING_VALUE_SQL, {'path' : path})
-        cur.execute(CLEAR_SETTING_PATH_SQL, {'path' : path})
+        with cls.__writer() as conn:
+            cur = conn.cursor()
+            cur.execute(CLEAR_SETTING_VALUE_SQL, {'path' : path})
+            cur.execute(CLEAR_SETTING_PATH_SQL, {'path' : path})
+        cls.__setting_changed(path)
+
+    @classmethod
+    def seal(cls):
+        '''關閉數據庫，並改回DELETE日誌模式
+
+        合併WAL日誌後，數據庫自成一個文件，方可作為系統詞典以不可變模式附加
+
+        '''
+        cls.sync()
+        cls.flush(True)
+        db_file = cls.__pool.db_file
+        cls.__pool.close()
+        cls.__pool = None
+        conn = sqlite3.connect(db_file)
+        DB.apply_pragmas(conn, [u'journal_mode = DELETE'])
+        conn.close()
 
     @classmethod
     def flush(cls, immediate=False):
         now = time.time()
         if immediate or now - cls.__last_flush_time > cls.FLUSH_INTERVAL:
-            cls.__conn.commit()
+            cls.__pool.commit()
             cls.__last_flush_time = now
 
     def __init__(self, name):
         self.__name = name
         self.__section = '%s/' % name
-        prefix_args = {'prefix' : self.read_config_value('Dict')}
-        _generate_dict_specific_sql(self, prefix_args)
+        # 本方案的設定值，構造時一次讀入；重新安裝方案後，新建的DB實例讀到的是新的設定
+        self.__config = DB.read_config(self.__section)
+        self.__prefix = self.read_config_value('Dict')
+        sql = DB.__dict_sql.get(self.__prefix)
+        if sql is None:
+            prefix_args = {'prefix' : self.__prefix}
+            _generate_dict_specific_sql(self, prefix_args)
+            if DB.system_db_file:
+                _generate_user_dict_sql(self, prefix_args)
+            sql = dict([(k, v) for k, v in self.__dict__.iteritems() if k.endswith('_sql')])
+            DB.__dict_sql[self.__prefix] = sql
+        else:
+            self.__dict__.update(sql)
+        if DB.system_db_file:
+            self.__open_user_dict()
         # for recovery from learning accidental user input
         self.__pending_updates = []
+        # 按設定值Option/UnigramIndex，首次查詢時載入內存索引
+        self.__use_index = DB.read_option(u'UnigramIndex') in (u'yes', u'true')
+        # 有zimedb-admin.py --compile生成的詞典文件時默認使用；設定Option/CompiledDict = no則不用
+        self.__use_compiled = DB.read_option(u'CompiledDict') not in (u'no', u'false')
+
+    def __open_user_dict(self):
+        '''建立用戶詞典；系統詞典重新安裝過，則按詞條文字將用戶數據對應到新的id'''
+        if DB.read_only or self.__prefix in DB.__user_dicts:
+            return
+        DB.__user_dicts.add(self.__prefix)
+        stamp = self.__read_stamp()
+        with DB.__writer() as conn:
+            conn.executescript(self._create_user_dict_sql)
+            last_stamp = conn.execute(self._query_user_stamp_sql).fetchone()[0]
+            if last_stamp != stamp:
+                if last_stamp is not None:
+                    debug('system dict has been reinstalled; remapping user dict:', self.__prefix)
+                    conn.executescript(self._remap_user_dict_sql)
+                conn.execute(self._update_user_stamp_sql, {'stamp': stamp})
+        DB.flush(True)
+
+    def __get_unigram_index(self):
+        if not self.__use_index:
+            return None
+        if self.__prefix in DB.__unigram_indices:
+            return DB.__unigram_indices[self.__prefix]
+        rows = DB.__query(self._query_unigram_index_sql)
+        stats = DB.__query_one(self._query_stats_sql)
+        index = DB.__unigram_indices[self.__prefix] = UnigramIndex(rows, stats)
+        return index
+
+    def __get_compiled_dict(self):
+        if not self.__use_compiled:
+            return None
+        if self.__prefix in DB.__compiled_dicts:
+            return DB.__compiled_dicts[self.__prefix]
+        d = None
+        path = DB.compiled_dict_path(self.__prefix)
+        if path and os.path.exists(path):
+            try:
+                d = CompiledDict(path)
+            except (IOError, ValueError, struct.error), e:
+                debug('error loading compiled dict:', e)
+            # 系統詞典重裝後，詞條id已不相同
+            if d and d.stamp != self.__read_stamp():
+                debug('compiled dict is out of date:', path)
+                d.close()
+                d = None
+            if d:
+                d.load_user_freq(DB.__query(self._query_ufreq_sql))
+        DB.__compiled_dicts[self.__prefix] = d
+        return d
+
+    def __read_stamp(self):
+        return DB.read_setting(u'DictStamp/%s' % self.__prefix) or u''
+
+    def compile(self):
+        '''生成編譯詞典，返回文件路徑'''
+        path = DB.compiled_dict_path(self.__prefix)
+        rows = DB.__query(self._query_compile_sql)
+        CompiledDict.build(path, rows, self.__read_stamp())
+        return path
+
+    def __drop_unigram_index(self):
+        if self.__prefix in DB.__unigram_indices:
+            del DB.__unigram_indices[self.__prefix]
+        d = DB.__compiled_dicts.pop(self.__prefix, None)
+        if d:
+            d.close()
+        DB.lookup_cache.invalidate_prefix(self.__prefix)
 
     def recreate_tables(self):
-        cur = DB.__conn.cursor()
-        cur.executescript(self._drop_dict_sql)
-        cur.executescript(self._create_dict_sql)
+        self.__drop_unigram_index()
+        with DB.__writer() as conn:
+            cur = conn.cursor()
+            cur.executescript(self._drop_dict_sql)
+            cur.executescript(self._create_dict_sql)
+        # 用戶詞典據此得知系統詞典已重裝
+        DB.update_setting(u'DictStamp/%s' % self.__prefix, unicode(time.time()))
+
+    def get_signature(self):
+        '''本方案的設定值及詞典版本；二者不變，據此建立的方案數據可在各會話間共用'''
+        return self.__config, self.__read_stamp()
 
     def read_config_value(self, key):
-        return DB.read_setting(self.__section + key)
+        r = self.__config.get(key)
+        return r[0] if r else None
 
     def read_config_list(self, key):
-        return DB.read_setting_list(self.__section + key)
+        return list(self.__config.get(key, ()))
         
     def list_keywords(self):
-        return [x[0] for x in DB.__conn.execute(self._list_keywords_sql, ()).fetchall()]
+        return [x[0] for x in DB.__query(self._list_keywords_sql)]
 
     def lookup_freq_total(self):
         self.proceed_pending_updates()
-        r = DB.__conn.execute(self._query_stats_sql).fetchone()
+        index = self.__get_unigram_index()
+        if index:
+            return index.lookup_stats()
+        r = DB.__query_one(self._query_stats_sql)
         return r
 
     def lookup_unigram(self, key):
         #print 'lookup_unigram:', key
+        index = self.__get_unigram_index() or self.__get_compiled_dict()
+        if index:
+            return index.lookup(key, DB.UNIG_LIMIT)
+        cache_key = ('u', self.__prefix, key)
+        r = DB.lookup_cache.get(cache_key)
+        if r is not None:
+            return r
+        generation = DB.lookup_cache.generation
         args = {'ikey' : key}
-        r = DB.__conn.execute(self._query_unigram_sql, args).fetchmany(DB.UNIG_LIMIT)
+        r = DB.__query(self._query_unigram_sql, args, DB.UNIG_LIMIT)
+        self.__cache_unigram(key, r, generation)
         return r
 
+    def lookup_unigram_many(self, keys):
+        '''一次查詢多個編碼的unigram，返回 {ikey: [(phrase, okey, eid, freq, ufreq), ...]}'''
+        index = self.__get_unigram_index() or self.__get_compiled_dict()
+        if index:
+            return dict([(k, index.lookup(k, DB.UNIG_LIMIT)) for k in keys])
+        result = dict()
+        missing = []
+        for k in keys:
+            r = DB.lookup_cache.get(('u', self.__prefix, k))
+            if r is None:
+                missing.append(k)
+            else:
+                result[k] = r
+        generation = DB.lookup_cache.generation
+        for k, r in self.__lookup_many(self._query_unigram_many_sql, missing, DB.UNIG_LIMIT):
+            self.__cache_unigram(k, r, generation)
+            result[k] = r
+        return result
+
+    def __cache_unigram(self, key, r, generation):
+        # 結果被截斷時，任一詞條的詞頻變化都可能改變它
+        refs = [('u', self.__prefix, x[2]) for x in r]
+        if len(r) >= DB.UNIG_LIMIT:
+            refs.append(('u', self.__prefix, None))
+        DB.lookup_cache.put(('u', self.__prefix, key), r, refs, generation)
+
     def lookup_bigram(self, key):
         #print 'lookup_bigram:', key
+        cache_key = ('b', self.__prefix, key)
+        r = DB.lookup_cache.get(cache_key)
+        if r is not None:
+            return r
+        generation = DB.lookup_cache.generation
         args = {'ikey' : key}
-        r = DB.__conn.execute(self._query_bigram_sql, args).fetchmany(DB.BIG_LIMIT)
+        r = DB.__query(self._query_bigram_sql, args, DB.BIG_LIMIT)
+        self.__cache_bigram(key, r, generation)
         return r
 
+    def lookup_bigram_many(self, keys):
+        '''一次查詢多個編碼的bigram，返回 {ikey: [(e1, e2, freq), ...]}'''
+        result = dict()
+        missing = []
+        for k in keys:
+            r = DB.lookup_cache.get(('b', self.__prefix, k))
+            if r is None:
+                missing.append(k)
+            else:
+                result[k] = r
+        generation = DB.lookup_cache.generation
+        for k, r in self.__lookup_many(self._query_bigram_many_sql, missing, DB.BIG_LIMIT):
+            self.__cache_bigram(k, r, generation)
+            result[k] = r
+        return result
+
+    def __cache_bigram(self, key, r, generation):
+        refs = [('b', self.__prefix, x[0], x[1]) for x in r]
+        if len(r) >= DB.BIG_LIMIT:
+            refs.append(('b', self.__prefix, None))
+        DB.lookup_cache.put(('b', self.__prefix, key), r, refs, generation)
+
+    def __lookup_many(self, sql, keys, limit):
+        '''以IN列表批量查詢，按ikey分組；查無結果的ikey對應空列表'''
+        keys = list(keys)
+        groups = dict([(k, []) for k in keys])
+        for n in range(0, len(keys), DB.MANY_LIMIT):
+            chunk = keys[n:n + DB.MANY_LIMIT]
+            for x in DB.__query(sql % u', '.join([u'?'] * len(chunk)), chunk):
+                g = groups[x[0]]
+                if len(g) < limit:
+                    g.append(x[1:])
+        return groups.iteritems()
+
     def lookup_bigram_by_entry(self, e):
         #print 'lookup_bigram_by_entry:', unicode(e)
         args = {'e1' : e.get_eid()}
-        r = DB.__conn.execute(self._query_bigram_by_entry_sql, args).fetchmany(DB.BIG_LIMIT)
+        r = DB.__query(self._query_bigram_by_entry_sql, args, DB.BIG_LIMIT)
         return r
 
     def update_freq_total(self, n):
         #print 'update_freq_total:', n
-        self.__pending_updates.append(lambda: self.__update_ufreq_total(n))
+        self.__pending_updates.append((lambda cur: self.__write_ufreq_total(cur, n),
+                                       lambda: self.__learn_ufreq_total(n)))
 
     def update_unigram(self, e):
         #print 'update_unigram:', unicode(e)
-        self.__pending_updates.append(lambda: self.__update_unigram(e))
+        self.__pending_updates.append((lambda cur: self.__write_unigram(cur, e),
+                                       lambda: self.__learn_unigram(e)))
 
     def update_bigram(self, a, b, indexer):
         #print 'update_bigram:', unicode(a), unicode(b)
-        self.__pending_updates.append(lambda: self.__update_bigram(a, b, indexer))
+        self.__pending_updates.append((lambda cur: self.__write_bigram(cur, a, b, indexer),
+                                       lambda: self.__learn_bigram(a, b, indexer)))
 
     def proceed_pending_updates(self):
         if self.__pending_updates:
-            for f in self.__pending_updates:
-                f()
+            if DB.read_only:
+                pass
+            elif DB.__learner:
+                DB.__learner.submit(self.__pending_updates)
+            else:
+                with DB.__writer() as conn:
+                    cur = conn.cursor()
+                    for write, learn in self.__pending_updates:
+                        write(cur)
+                for write, learn in self.__pending_updates:
+                    learn()
+                DB.flush()
             self.__pending_updates = []
 
     def cancel_pending_updates(self):
         if self.__pending_updates:
             self.__pending_updates = []
 
-    def __update_ufreq_total(self, n):
-        if DB.read_only:
-            return
+    def __write_ufreq_total(self, cur, n):
         args = {'n' : n}
-        DB.__conn.execute(self._update_ufreq_total_sql, args)
-        DB.flush()
+        cur.execute(self._update_ufreq_total_sql, args)
+
+    def __learn_ufreq_total(self, n):
+        if self.__prefix in DB.__unigram_indices:
+            DB.__unigram_indices[self.__prefix].update_stats(n)
         
-    def __update_unigram(self, e):
-        if DB.read_only:
-            return
+    def __write_unigram(self, cur, e):
+        self.__add_user_entries(cur, [e])
         args = {'id' : e.get_eid(), 'freq': 1}
-        DB.__conn.execute(self._inc_ufreq_sql, args)
-
-    def __update_bigram(self, a, b, indexer):
-        if DB.read_only:
-            return
-        cur = DB.__conn.cursor()
+        cur.execute(self._inc_ufreq_sql, args)
+
+    def __add_user_entries(self, cur, entries):
+        if self._add_user_entry_sql:
+            args = [{'id': e.get_eid(), 'phrase': e.get_word(), 'okey': e.get_okey()} for e in entries]
+            cur.executemany(self._add_user_entry_sql, args)
+
+    def __learn_unigram(self, e):
+        if self.__prefix in DB.__unigram_indices:
+            DB.__unigram_indices[self.__prefix].update_freq(e.get_eid(), 1)
+        if DB.__compiled_dicts.get(self.__prefix):
+            DB.__compiled_dicts[self.__prefix].update_freq(e.get_eid(), 1)
+        DB.lookup_cache.invalidate(('u', self.__prefix, e.get_eid()))
+        DB.lookup_cache.invalidate(('u', self.__prefix, None))
+
+    def __write_bigram(self, cur, a, b, indexer):
         args = {'e1' : a.get_eid(), 'e2' : b.get_eid(), 'freq': 1}
         if cur.execute(self._bigram_exist_sql, args).fetchone():
             cur.execute(self._inc_bfreq_sql, args)
         else:
+            self.__add_user_entries(cur, [a, b])
             cur.execute(self._add_bigram_sql, args)
             # generate ikey-bigram index
             b_id = cur.execute(self._bigram_exist_sql, args).fetchone()[0]
             okey = u' '.join([a.get_okey(), b.get_okey()])
-            k_ids = [self.__get_or_insert_key(k) for k in indexer(okey)]
+            k_ids = [self.__get_or_insert_key(cur, k) for k in indexer(okey)]
             for k_id in k_ids:
-                self.__add_kb(k_id, b_id)
+                self.__add_kb(cur, k_id, b_id)
+
+    def __learn_bigram(self, a, b, indexer):
+        okey = u' '.join([a.get_okey(), b.get_okey()])
+        DB.lookup_cache.invalidate(('b', self.__prefix, a.get_eid(), b.get_eid()))
+        DB.lookup_cache.invalidate_keys([('b', self.__prefix, k) for k in indexer(okey)])
+        DB.lookup_cache.invalidate(('b', self.__prefix, None))
 
-    def __get_or_insert_key(self, key):
-        cur = DB.__conn.cursor()
+    def __get_or_insert_key(self, cur, key):
         args = {'ikey' : key}
         r = None
         while not r:
-            r = cur.execute(self._query_key_sql, args).fetchone()
+            r = cur.execute(self._query_bigram_key_sql, args).fetchone()
             if not r:
-                cur.execute(self._add_key_sql, args)
+                cur.execute(self._add_bigram_key_sql, args)
         return r[0]
 
-    def __add_kb(self, k_id, b_id):
+    def __add_kb(self, cur, k_id, b_id):
         args = {'k_id' : k_id, 'b_id' : b_id}
-        if not DB.__conn.execute(self._query_kb_sql, args).fetchone():
-            DB.__conn.execute(self._add_kb_sql, args)
+        if not cur.execute(self._query_kb_sql, args).fetchone():
+            cur.execute(self._add_kb_sql, args)
 
     # used by zimedb-admin.py
 
     @classmethod
     def get_schema_list(self):
-        schema_list = DB.__conn.execute(QUERY_SCHEMA_LIST_SQL).fetchall()
+        schema_list = DB.__query(DB.__query_schema_list_sql)
         return schema_list
 
     @classmethod
     def get_installed_dicts(self):
-        prefixes = DB.__conn.execute(QUERY_DICT_PREFIX_SQL).fetchall()
+        prefixes = DB.__query(DB.__query_dict_prefix_sql)
         return prefixes
 
     def drop_tables(self, compact=False):
-        DB.__conn.executescript(self._drop_dict_sql)
+        self.__drop_unigram_index()
+        with DB.__writer() as conn:
+            conn.executescript(self._drop_dict_sql)
+        DB.clear_setting(u'DictStamp/%s' % self.__prefix)
 
     @classmethod
     def compact(cls):
-        DB.__conn.execute("""VACUUM;""")
+        with DB.__writer() as conn:
+            conn.commit()
+            conn.execute("""VACUUM;""")
     
     def add_keywords(self, keywords):
         args = [{'keyword': k} for k in keywords]
-        DB.__conn.executemany(self._add_keyword_sql, args)
+        with DB.__writer() as conn:
+            conn.executemany(self._add_keyword_sql, args)
 
     def add_phrases(self, phrase_table, indexer, reporter=None):
-        '''批量添加詞條並以indexer建立編碼索引'''
-        # 第一趟，讀取phrase id，寫入新增詞條
-        phrase_id = dict()
-        missing_phrases = set()
-        for (k, freq) in phrase_table:
-            phrase = k[0]
-            p_id = self.__get_phrase_id(phrase)
-            if p_id:
-                phrase_id[phrase] = p_id
+        '''批量添加詞條並以indexer建立編碼索引
+
+        詞條先寫入臨時表，再以INSERT ... SELECT解析phrase id及unigram id，整個過程在一個事務中完成
+        向空詞典導入時，(p_id, okey)索引待數據寫完後再建
+
+        '''
+        self.__drop_unigram_index()
+        rows = [(phrase, okey, freq) for ((phrase, okey), freq) in phrase_table]
+        total = sum([x[2] for x in rows])
+        with DB.__bulk_transaction() as conn:
+            cur = conn.cursor()
+            for sql in DROP_BULK_TABLES_SQL:
+                cur.execute(sql)
+            cur.execute(CREATE_BULK_PHRASES_SQL)
+            cur.execute(CREATE_BULK_KEYS_SQL)
+            cur.executemany(ADD_BULK_PHRASE_SQL, rows)
+            del rows
+            cur.execute(BULK_ADD_PHRASES_SQL)
+            cur.execute(self._bulk_group_unigrams_sql)
+            deferred = cur.execute(self._unigram_empty_sql).fetchone()[0]
+            if deferred:
+                cur.execute(self._drop_entry_index_sql)
             else:
-                missing_phrases.add(phrase)
-        if missing_phrases:
-            table = [{'phrase': p} for p in missing_phrases]
-            DB.__conn.executemany(ADD_PHRASE_SQL, table)
-        for phrase in missing_phrases:
-            p_id = self.__get_phrase_id(phrase)
-            if p_id:
-                phrase_id[phrase] = p_id
-        # 第二趟，累計詞頻、生成unigram
-        unigram_freq = dict()
-        total = 0
-        for (k, freq) in phrase_table:
-            if k in unigram_freq:
-                unigram_freq[k] += freq
-            else:
-                unigram_freq[k] = freq
-            total += freq
-        increment = list()
-        missing_unigrams = set()
-        for (phrase, okey), freq in unigram_freq.iteritems():
-            p_id = phrase_id[phrase]
-            u_id = self.__get_unigram_id(p_id, okey)
-            if u_id:
                 # 已有unigram，累計詞頻
-                if freq > 0:
-                    increment.append({'id': u_id, 'freq': freq})
-            else:
-                missing_unigrams.add((phrase, okey))
-                if reporter:
+                cur.execute(self._bulk_match_unigrams_sql)
+                cur.execute(CREATE_BULK_UNIGRAMS_INDEX_SQL)
+                cur.execute(self._bulk_inc_sfreq_sql)
+            # 新增的unigram id均大於max_id
+            args = {'id': cur.execute(self._query_max_unigram_id_sql).fetchone()[0]}
+            cur.execute(self._bulk_add_unigrams_sql)
+            if total > 0:
+                cur.execute(self._update_sfreq_total_sql, {'n': total})
+            if reporter:
+                for (phrase, okey) in cur.execute(self._query_new_unigrams_sql, args).fetchall():
                     reporter(phrase, okey)
-        if missing_unigrams:
-            table = [{'p_id': phrase_id[k[0]], 'okey': k[1], 'freq': unigram_freq[k]}
-                     for k in missing_unigrams]
-            DB.__conn.executemany(self._add_unigram_sql, table)
-        if increment:
-            DB.__conn.executemany(self._inc_sfreq_sql, increment)
-        if total > 0:
-            self.__inc_freq_total(total)
-        
-        # 建立索引
-        key_id = dict()
-        missing_keys = set()
-        missing_ku_links = set()
-        for (phrase, okey) in missing_unigrams:
-            u_id = self.__get_unigram_id(phrase_id[phrase], okey)
-            if not u_id:
-                # shouldn't happen!
-                continue
-            for key in indexer(okey):
-                missing_ku_links.add((key, u_id))
-                k_id = self.__get_key_id(key)
-                if k_id:
-                    key_id[key] = k_id
-                else:
-                    missing_keys.add(key)
-        if missing_keys:
-            table = [{'ikey': k} for k in missing_keys]
-            DB.__conn.executemany(self._add_key_sql, table)
-        for key in missing_keys:
-            k_id = self.__get_key_id(key)
-            if k_id:
-                key_id[key] = k_id
-        if missing_ku_links:
-            table = [{'k_id': key_id[k], 'u_id': u} for (k, u) in missing_ku_links]
-            DB.__conn.executemany(self._add_ku_sql, table)
+            # 建立索引
+            okeys = [x[0] for x in cur.execute(self._query_new_okeys_sql, args).fetchall()]
+            cur.executemany(ADD_BULK_KEY_SQL, [(okey, k) for okey in okeys for k in indexer(okey)])
+            cur.execute(CREATE_BULK_KEYS_INDEX_SQL)
+            cur.execute(self._bulk_add_keys_sql)
+            cur.execute(self._bulk_add_ku_sql, args)
+            if deferred:
+                cur.execute(self._create_entry_index_sql)
+            for sql in DROP_BULK_TABLES_SQL:
+                cur.execute(sql)
 
     def __get_phrase_id(self, phrase):
         args = {'phrase': phrase}
-        r = DB.__conn.execute(QUERY_PHRASE_SQL, args).fetchone()
-        return r[0] if r else None
-
-    def __get_key_id(self, key):
-        args = {'ikey': key}
-        r = DB.__conn.execute(self._query_key_sql, args).fetchone()
+        r = DB.__query_one(QUERY_PHRASE_SQL, args)
         return r[0] if r else None
 
     def __get_unigram_id(self, p_id, okey):
         args = {'p_id': p_id, 'okey': okey}
-        r = DB.__conn.execute(self._unigram_exist_sql, args).fetchone()
+        r = DB.__query_one(self._unigram_exist_sql, args)
         return r[0] if r else None
 
-    def __inc_freq_total(self, n):
-        args = {'n' : n}
-        DB.__conn.execute(self._update_sfreq_total_sql, args)
-
     def dump_user_freq(self):
-        return DB.__conn.execute(self._query_user_freq_sql).fetchall()
+        return DB.__query(self._query_user_freq_sql)
     
     def dump_user_gram(self):
-        return DB.__conn.execute(self._query_user_gram_sql).fetchall()
+        return DB.__query(self._query_user_gram_sql)
 
     def restore_user_freq(self, freq_table):
-        cur = DB.__conn.cursor()
+        self.__drop_unigram_index()
         unigram_freq = dict()
         for (u, n) in freq_table:
             if u in unigram_freq:
@@ -602,12 +1868,16 @@ class DB:
         for (phrase, okey), n in unigram_freq.iteritems():
             table.append({'phrase': phrase, 'okey': okey, 'freq': n})
             total_increment += n
-        cur.executemany(self._update_user_freq_sql, table)
-        if total_increment > 0:
-            cur.execute(self._update_ufreq_total_sql, {'n': total_increment})
+        with DB.__writer() as conn:
+            cur = conn.cursor()
+            if self._add_user_freq_sql:
+                cur.executemany(self._add_user_freq_sql, table)
+            cur.executemany(self._update_user_freq_sql, table)
+            if total_increment > 0:
+                cur.execute(self._update_ufreq_total_sql, {'n': total_increment})
 
     def restore_user_gram(self, freq_table, indexer):
-        cur = DB.__conn.cursor()
+        DB.lookup_cache.invalidate_prefix(self.__prefix)
         bigram_freq = dict()
         for (a, b, n) in freq_table:
             k = (a, b)
@@ -617,6 +1887,7 @@ class DB:
                 bigram_freq[k] = n
         missing = list()
         increment = list()
+        entries = list()
         for ((phrase1, okey1), (phrase2, okey2)), n in bigram_freq.iteritems():
             p1 = self.__get_phrase_id(phrase1)
             if not p1:
@@ -631,15 +1902,22 @@ class DB:
             if not e2:
                 continue
             args = {'e1': e1, 'e2': e2, 'freq': n, 'okey': u' '.join([okey1, okey2])}
-            if cur.execute(self._bigram_exist_sql, args).fetchone():
+            if DB.__query_one(self._bigram_exist_sql, args):
                 increment.append(args)
             else:
                 missing.append(args)
-        cur.executemany(self._inc_bfreq_sql, increment)
-        cur.executemany(self._add_bigram_sql, missing)
-        # generate ikey-bigram index
-        for args in missing:
-            b_id = cur.execute(self._bigram_exist_sql, args).fetchone()[0]
-            k_ids = [self.__get_or_insert_key(k) for k in indexer(args['okey'])]
-            for k_id in k_ids:
-                self.__add_kb(k_id, b_id)
+                if self._add_user_entry_sql:
+                    entries.append({'id': e1, 'phrase': phrase1, 'okey': okey1})
+                    entries.append({'id': e2, 'phrase': phrase2, 'okey': okey2})
+        with DB.__writer() as conn:
+            cur = conn.cursor()
+            if entries:
+                cur.executemany(self._add_user_entry_sql, entries)
+            cur.executemany(self._inc_bfreq_sql, increment)
+            cur.executemany(self._add_bigram_sql, missing)
+            # generate ikey-bigram index
+            for args in missing:
+                b_id = cur.execute(self._bigram_exist_sql, args).fetchone()[0]
+                k_ids = [self.__get_or_insert_key(cur, k) for k in indexer(args['okey'])]
+                for k_id in k_ids:
+                    self.__add_kb(cur, k_id, b_id)
@@ -69,6 +69,8 @@ def main():
         if os.fork():
             sys.exit()
 
+    # 後台線程（用戶詞頻寫入、異步查詢）須在主循環空閒時得以運行
+    gobject.threads_init()
     IMApp(exec_by_ibus).run()
 
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ __all__ = (
 )
 
 import os
+import gobject
 import ibus
 from core import *
 from engine import *
@@ -23,6 +24,7 @@ class RimeSession(ibus.EngineBase, Frontend):
         super(RimeSession, self).__init__(conn, object_path)
         self.__page_size = storage.DB.read_setting(u'Option/PageSize') or 5
         self.__lookup_table = ibus.LookupTable(self.__page_size)
+        self.__candidates = []
         self.__backend = Engine(self)
 
     def process_key_event(self, keyval, keycode, mask):
@@ -74,18 +76,27 @@ class RimeSession(ibus.EngineBase, Frontend):
         '''
         self.__lookup_table.clean()
         self.__lookup_table.show_cursor(False)
+        self.__candidates = candidates
         if not candidates:
             self.hide_lookup_table()
         else:
-            for c in candidates:
-                self.__lookup_table.append_candidate(ibus.Text(c[0]))
-            self.update_lookup_table(self.__lookup_table, True, True)
+            self.__update_lookup_table()
+
+    def __update_lookup_table(self):
+        '''候選按需生成；向LookupTable補足到下一頁末尾，再更新顯示
+        '''
+        n = self.__lookup_table.get_number_of_candidates()
+        p = self.__lookup_table.get_page_size()
+        end = (self.__lookup_table.get_cursor_pos() / p + 2) * p
+        for c in self.__candidates[n:end]:
+            self.__lookup_table.append_candidate(ibus.Text(c[0]))
+        self.update_lookup_table(self.__lookup_table, True, True)
     
     def page_up(self):
         '''上翻頁
         '''
         if self.__lookup_table.page_up():
-            self.update_lookup_table(self.__lookup_table, True, True)
+            self.__update_lookup_table()
             return True
         return False
 
@@ -93,7 +104,7 @@ class RimeSession(ibus.EngineBase, Frontend):
         '''下翻頁
         '''
         if self.__lookup_table.page_down():
-            self.update_lookup_table(self.__lookup_table, True, True)
+            self.__update_lookup_table()
             return True
         return False
 
@@ -101,7 +112,7 @@ class RimeSession(ibus.EngineBase, Frontend):
         '''高亮上一候選
         '''
         if self.__lookup_table.cursor_up():
-            self.update_lookup_table(self.__lookup_table, True, True)
+            self.__update_lookup_table()
             return True
         return False
 
@@ -109,12 +120,17 @@ class RimeSession(ibus.EngineBase, Frontend):
         '''高亮下一候選
         '''
         if self.__lookup_table.cursor_down():
-            self.update_lookup_table(self.__lookup_table, True, True)
+            self.__update_lookup_table()
             return True
         return False
 
+    def call_soon(self, func):
+        '''在主循環中稍後執行func
+        '''
+        gobject.idle_add(lambda: func() and False)
+
     def focus_in(self):
-        self.__backend.on_update()
+        self.__backend.update_ui(force=True)
 
     def focus_out(self):
         switcher = self.__backend.switcher
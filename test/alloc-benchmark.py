@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:set et sts=4 sw=4:
+
+'''統計長句輸入時每次擊鍵創建的 Entry 對象數目及其內存佔用
+
+用法: python alloc-benchmark.py [Schema] [keys]
+'''
+
+import codecs
+import gc
+import os
+import sys
+
+from test import TestSession
+
+import builder
+
+
+def entry_size(x):
+    size = sys.getsizeof(x)
+    if hasattr(x, '__dict__'):
+        size += sys.getsizeof(x.__dict__)
+    return size
+
+def live_entries():
+    return [x for x in gc.get_objects() if isinstance(x, builder.Entry)]
+
+def main():
+    schema = unicode(sys.argv[1]) if len(sys.argv) > 1 else u'Pinyin'
+    keys = sys.argv[2] if len(sys.argv) > 2 else \
+        'zhonghuarenmingongheguoshiyigeweidadeguojiawomenreaizuguodeshanhe'
+    created = [0]
+    init = builder.Entry.__init__
+    def counting_init(self, *args, **kwargs):
+        created[0] += 1
+        init(self, *args, **kwargs)
+    builder.Entry.__init__ = counting_init
+    counts = []
+    stdout = sys.stdout
+    sys.stdout = codecs.open(os.devnull, 'w', 'utf-8')
+    try:
+        e = TestSession(schema)
+        for c in keys:
+            created[0] = 0
+            e.feed(c)
+            counts.append(created[0])
+        live = live_entries()
+    finally:
+        sys.stdout = stdout
+        builder.Entry.__init__ = init
+    print 'keystrokes:               %d' % len(counts)
+    print 'entries created in total: %d' % sum(counts)
+    print 'entries per keystroke:    avg %.1f, last %d, max %d' % \
+        (float(sum(counts)) / len(counts), counts[-1], max(counts))
+    if live:
+        print 'bytes per entry:          %d' % entry_size(live[0])
+        print 'live entries:             %d (%d bytes)' % \
+            (len(live), sum(entry_size(x) for x in live))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:set et sts=4 sw=4:
+
+'''按預錄的擊鍵腳本逐方案重放，統計每次擊鍵的耗時，及方案數據載入後新建會話的耗時
+
+用法: python replay-benchmark.py [options] [Schema ...]
+
+擊鍵腳本沿用 TestSession.feed 的寫法，另以 {~KeyName} 表示鬆開按鍵（用於宮保拼音的並擊）
+每輪重放前將 test.db 複製到臨時目錄，不改動原文件，重放的結果因而是確定的
+每個方案在單獨的進程中運行，以便分別統計內存佔用峰值
+以 -o 保存 JSON 格式的結果，以 -c 與先前保存的結果比較
+有方案運行失敗，或與先前的結果相比變慢時，以狀態1退出
+
+'''
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPTS = {
+    u'Pinyin': [
+        'woshizhongguoren ',
+        'zhonghuarenmingongheguoshiyigeweidadeguojia ',
+        'changanshizhongguodeshoudu{Home}{Right}{Right} {Return}',
+        'nihao{Page_Down}{Page_Up}{Down}2',
+        'jiongqiongxiongyong{BackSpace}{BackSpace}{BackSpace}{BackSpace}yong ',
+        "xi'an{BackSpace}{BackSpace}{BackSpace}ian ",
+        'xianzaishijianshiershidian ',
+    ],
+    u'TonalPinyin': [
+        'woyebuzhidaoshibushi .jiong ',
+        'zhong-guo/ren/ ',
+        'pkucn.com{Return}',
+        'nihaoma ',
+    ],
+    u'Zhuyin': [
+        'rm/3rm/3u.3gp6zj/ {Escape}2k7al {Tab}{Return}',
+        '5j/ ej6bp6 ',
+        'su3cl3 ',
+    ],
+    u'Quick': [
+        "hi'l'wm'o ",
+        'ofvd ',
+        'lwmo{BackSpace}o ',
+    ],
+    u'Jyutping': [
+        'jyuhomindeoicangjatheizaugwodikjatzi ',
+        'ngohaiheunggongjan ',
+        'neihou{BackSpace}{BackSpace}hou ',
+    ],
+    u'Wu': [
+        'nguho ',
+        'ngu{BackSpace}{BackSpace}{BackSpace}ho ',
+    ],
+    u'DoublePinyin': [
+        'wouivsgorf ',
+        'nihk ',
+        'vsgodeubdu{BackSpace}{BackSpace}du ',
+    ],
+    u'ComboPinyin': [
+        'rjkl{~r}{~j}{~k}{~l} {~space}',
+        'rjkl{~r}{~j}{~k}{~l}rjkl{~r}{~j}{~k}{~l}{Return}',
+        'rjkl{~r}{~j}{~k}{~l}rjkl{~r}{~j}{~k}{~l} {~space}',
+    ],
+}
+
+SCHEMAS = [u'Pinyin', u'TonalPinyin', u'Zhuyin', u'Quick',
+           u'Jyutping', u'Wu', u'DoublePinyin', u'ComboPinyin']
+
+# 統計新建會話耗時的次數
+SESSIONS = 20
+
+
+def key_events(script):
+    '''將擊鍵腳本解析為 (keyname, release) 序列'''
+    key_name = None
+    for c in script:
+        if c == '{':
+            key_name = ''
+        elif c == '}':
+            if key_name.startswith('~'):
+                yield key_name[1:], True
+            else:
+                yield key_name, False
+            key_name = None
+        elif key_name is not None:
+            key_name += c
+        else:
+            yield c, False
+
+
+def percentile(s, p):
+    if not s:
+        return None
+    return s[min(len(s) - 1, int(len(s) * p))]
+
+
+def peak_memory():
+    '''進程的內存佔用峰值，單位KB；無resource模塊時返回None'''
+    if resource is None:
+        return None
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Mac OS X 以字節為單位
+    return r / 1024 if sys.platform == 'darwin' else r
+
+
+def run_schema(schema_id, db_file, rounds):
+    '''在當前進程中重放一個方案的腳本；須在導入引擎之前設定 ZIME_DATABASE'''
+    os.environ['ZIME_DATABASE'] = db_file
+    sys.path.append(os.path.normpath(os.path.join(here, '..', 'engine')))
+    import ibus
+    from core import Frontend, KeyEvent, keysyms, modifier
+    from engine import Engine
+    from storage import DB
+
+    if schema_id not in [x[0] for x in DB.read_setting_items(u'SchemaList/')]:
+        return {'skipped': 'not installed'}
+
+    class BenchmarkSession(Frontend):
+
+        '''不作輸出的前端；如同Weasel，候選只取到下一頁為止'''
+
+        def __init__(self):
+            self.commits = 0
+            self.__lookup_table = ibus.LookupTable()
+            self.__backend = Engine(self, schema_id)
+
+        def process_key_event(self, keycode, mask):
+            return self.__backend.process_key_event(KeyEvent(keycode, mask))
+
+        def commit_string(self, s):
+            self.commits += 1
+
+        def update_candidates(self, candidates):
+            self.__lookup_table.clean()
+            page_size = self.__lookup_table.get_page_size()
+            for c in candidates[:page_size * 2] if candidates else []:
+                self.__lookup_table.append_candidate(ibus.Text(c[0]))
+
+        def get_candidate_index(self, number):
+            return number + self.__lookup_table.get_current_page_start()
+
+        def get_highlighted_candidate_index(self):
+            return self.__lookup_table.get_cursor_pos()
+
+    events = []
+    for script in SCRIPTS[schema_id]:
+        for name, release in key_events(script):
+            keycode = ord(name) if len(name) == 1 else keysyms.name_to_keycode(name)
+            events.append((keycode, modifier.RELEASE_MASK if release else 0))
+
+    start = time.time()
+    session = BenchmarkSession()
+    startup = time.time() - start
+    # 首輪用於預熱，不計入統計
+    for keycode, mask in events:
+        session.process_key_event(keycode, mask)
+    session.commits = 0
+    # 方案數據已載入，此後新建會話的耗時
+    start = time.time()
+    for i in range(SESSIONS):
+        BenchmarkSession()
+    session_time = (time.time() - start) / SESSIONS
+    samples = []
+    elapsed = 0.0
+    for r in range(rounds):
+        for keycode, mask in events:
+            t = time.time()
+            session.process_key_event(keycode, mask)
+            t = time.time() - t
+            samples.append(t * 1000)
+            elapsed += t
+    DB.sync()
+    samples.sort()
+    return {
+        'keystrokes': len(samples),
+        'startup_ms': startup * 1000,
+        'session_ms': session_time * 1000,
+        'p50_ms': percentile(samples, 0.50),
+        'p95_ms': percentile(samples, 0.95),
+        'p99_ms': percentile(samples, 0.99),
+        'max_ms': samples[-1] if samples else None,
+        'mean_ms': sum(samples) / len(samples) if samples else None,
+        'commits': session.commits,
+        'commits_per_sec': session.commits / elapsed if elapsed else None,
+        'peak_memory_kb': peak_memory(),
+    }
+
+
+def spawn(schema_id, db_file, rounds):
+    '''在子進程中運行，以臨時目錄中的數據庫副本重放'''
+    tmp_dir = tempfile.mkdtemp(prefix='rime-benchmark-')
+    try:
+        db_copy = os.path.join(tmp_dir, os.path.basename(db_file))
+        shutil.copy(db_file, db_copy)
+        # 尚未合併的WAL日誌一併複製
+        if os.path.exists(db_file + '-wal'):
+            shutil.copy(db_file + '-wal', db_copy + '-wal')
+        # 編譯詞典與拼寫運算緩存與數據庫放在一起
+        src_dir = os.path.dirname(os.path.abspath(db_file))
+        for f in os.listdir(src_dir):
+            if f.endswith('.dict.bin') or f.endswith('.algebra.bin'):
+                shutil.copy(os.path.join(src_dir, f), tmp_dir)
+        args = [sys.executable, os.path.abspath(__file__), '--child',
+                '-d', db_copy, '-r', str(rounds), schema_id.encode('utf-8')]
+        p = subprocess.Popen(args, stdout=subprocess.PIPE)
+        out = p.communicate()[0]
+        if p.returncode != 0:
+            return {'failed': 'exit code %d' % p.returncode}
+        return json.loads(out.splitlines()[-1])
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def compare(baseline, results, threshold):
+    '''與先前的結果比較；返回是否有方案變慢超過threshold，或先前有結果的方案運行失敗'''
+    regressed = False
+    print '%-14s %-8s %10s %10s %8s' % ('schema', 'metric', 'baseline', 'current', 'change')
+    for schema_id in SCHEMAS:
+        old, new = baseline.get(schema_id), results.get(schema_id)
+        if not old or not new or 'skipped' in old or 'failed' in old:
+            continue
+        if 'failed' in new:
+            print '%-14s failed: %s !' % (schema_id, new['failed'])
+            regressed = True
+            continue
+        if 'skipped' in new:
+            continue
+        for k in ('p50_ms', 'p95_ms', 'p99_ms', 'session_ms', 'commits_per_sec', 'peak_memory_kb'):
+            if not old.get(k) or new.get(k) is None:
+                continue
+            change = (new[k] - old[k]) / old[k]
+            # 每秒上屏數越大越好，其餘越小越好
+            worse = -change if k == 'commits_per_sec' else change
+            flag = ''
+            if worse > threshold:
+                flag = ' !'
+                regressed = True
+            print '%-14s %-8s %10.2f %10.2f %+7.1f%%%s' % (
+                schema_id, k.split('_')[0], old[k], new[k], change * 100, flag)
+    return regressed
+
+
+def main():
+    parser = optparse.OptionParser('%prog [options] [Schema ...]')
+    parser.add_option('-d', '--db-file', dest='db_file', default=os.path.join(here, 'test.db'),
+                      help='prepared db to replay against (default: test.db)', metavar='FILE')
+    parser.add_option('-r', '--rounds', dest='rounds', type='int', default=5,
+                      help='rounds to replay after warm-up (default: 5)')
+    parser.add_option('-o', '--output', dest='output', help='save results as JSON', metavar='FILE')
+    parser.add_option('-c', '--compare', dest='baseline', help='compare with saved JSON results', metavar='FILE')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float', default=0.1,
+                      help='relative slowdown reported as a regression (default: 0.1)')
+    parser.add_option('--child', action='store_true', dest='child', default=False, help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    schemas = [x.decode('utf-8') for x in args] or SCHEMAS
+    for x in schemas:
+        if x not in SCRIPTS:
+            parser.error('no key scripts for schema: %s' % x)
+
+    if options.child:
+        # 引擎的輸出一概略去，最後一行為結果
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            r = run_schema(schemas[0], options.db_file, options.rounds)
+        finally:
+            sys.stdout = stdout
+        print json.dumps(r)
+        return
+
+    if not os.path.exists(options.db_file):
+        parser.error('db file not found: %s; run prepare-test-db.sh first' % options.db_file)
+    results = dict()
+    for schema_id in schemas:
+        r = results[schema_id] = spawn(schema_id, options.db_file, options.rounds)
+        if 'skipped' in r:
+            print '%-14s skipped: %s' % (schema_id, r['skipped'])
+            continue
+        if 'failed' in r:
+            print '%-14s FAILED: %s' % (schema_id, r['failed'])
+            continue
+        print '%-14s %5d keys  p50 %6.2f  p95 %6.2f  p99 %6.2f ms  session %5.2f ms  %7.1f commits/s  peak %s KB' % (
+            schema_id, r['keystrokes'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r.get('session_ms', 0),
+            r['commits_per_sec'] or 0, r['peak_memory_kb'])
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'time': time.time(), 'rounds': options.rounds, 'results': results},
+                      f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(baseline, results, options.threshold):
+            sys.exit(1)
+    if [r for r in results.itervalues() if 'failed' in r]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -35,6 +35,10 @@ class TestSession(Frontend):
             (keysyms.keycode_to_name(keycode), keycode, mask)
         return self.__backend.process_key_event(KeyEvent(keycode, mask))
 
+    def process_key_events(self, events):
+        print "process_key_events: %d events" % len(events)
+        return self.__backend.process_key_events([KeyEvent(keycode, mask) for keycode, mask in events])
+
     def commit_string(self, s):
         print u'commit: [%s]' % s
 
@@ -61,8 +65,6 @@ class TestSession(Frontend):
             #self.hide_lookup_table()
             pass
         else:
-            for c in candidates:
-                self.__lookup_table.append_candidate(ibus.Text(c[0]))
             #self.update_lookup_table(self.__lookup_table, True, True)
             self.__candidates = candidates
             self.__update_lookup_table()
@@ -70,16 +72,16 @@ class TestSession(Frontend):
     def __update_lookup_table(self):
         start = self.__lookup_table.get_current_page_start()
         end = start + self.__lookup_table.get_page_size()
+        # 候選按需生成，只補足到下一頁為止
+        n = self.__lookup_table.get_number_of_candidates()
+        for c in self.__candidates[n:end + self.__lookup_table.get_page_size()]:
+            self.__lookup_table.append_candidate(ibus.Text(c[0]))
         cursor_pos = start + self.__lookup_table.get_cursor_pos_in_current_page()
-        c = self.__candidates
+        c = self.__candidates[start:end]
         for i in range(len(c)):
-            if i < start:
-                continue
-            if i >= end:
-                break
             print u'candidate: %d%s %s' % (
-                i + 1,
-                u'*' if i == cursor_pos else u'.', 
+                start + i + 1,
+                u'*' if start + i == cursor_pos else u'.', 
                 c[i][0]
             )
             
@@ -125,14 +127,16 @@ class TestSession(Frontend):
         print u'highlighted_candidate_index = %d' % index
         return index
 
-    def feed(self, string):
+    def feed(self, string, batch=False):
         '''emulate input process with a key sequence.
 
         a key can be represented by the printable ascii letter it produces,
         or a {KeyName} form.
         example: "pin'yin shurufa{Return}"
+        with batch=True the whole sequence is sent in a single process_key_events call.
 
         '''
+        events = []
         key_name = ''
         is_key_name = False
         for c in string:
@@ -141,11 +145,16 @@ class TestSession(Frontend):
                 key_name = ''
             elif c == '}':
                 is_key_name = False
-                self.process_key_event(keysyms.name_to_keycode(key_name), 0)
+                events.append((keysyms.name_to_keycode(key_name), 0))
             elif is_key_name:
                 key_name += c
             else:
-                self.process_key_event(ord(c), 0)
+                events.append((ord(c), 0))
+        if batch:
+            self.process_key_events(events)
+        else:
+            for keycode, mask in events:
+                self.process_key_event(keycode, mask)
 
 def test_switcher():
     # calls schema switcher
@@ -200,6 +209,13 @@ def test_combo_pinyin():
     e.process_key_event(keysyms.space, 0)
     e.process_key_event(keysyms.space, modifier.RELEASE_MASK)
 
+def test_batch():
+    e = TestSession(u'Pinyin')
+    e.feed('woshizhongguoren ', batch=True)
+    e.feed('zhonghuarenmingongheguo', batch=True)
+    e.feed('{Home}{Right}{Right}', batch=True)
+    e.feed('{Escape}nihao{Page_Down}{Page_Up}{Down}2', batch=True)
+
 def test_jyutping():
     e = TestSession(u'Jyutping')
     e.feed('jyuhomindeoicangjatheizaugwodikjatzi')
@@ -210,6 +226,20 @@ def test_tonal_pinyin():
     e.feed('pkucn.com')
     e.feed('3.14wo1.0')
 
+def test_db_profile():
+    # 主線程的只讀連接先於載入連接參數打開，也須套用調校過的參數
+    import threading
+    from storage import DB
+    result = dict()
+    def read():
+        result['thread'] = DB.read_pragma(u'mmap_size')
+    t = threading.Thread(target=read)
+    t.start()
+    t.join()
+    main_thread = DB.read_pragma(u'mmap_size')
+    print 'mmap_size: main thread %s, other thread %s' % (main_thread, result['thread'])
+    assert main_thread == result['thread']
+
 def main():
     #test_pinyin()
     #test_rawmode()
@@ -37,6 +37,24 @@ def feed(session, input):
             print session.process_key_event(ord(c), 0)
             print session.get_response()
 
+def feed_batch(session, input):
+    events = []
+    name = ''
+    is_name = False
+    for c in input:
+        if c == '{':
+            name = ''
+            is_name = True
+        elif c == '}':
+            is_name = False
+            events.append((keysyms.name_to_keycode(name), 0))
+        elif is_name:
+            name += c
+        else:
+            events.append((ord(c), 0))
+    print session.process_key_events(events)
+    print session.get_response()
+
 def test(session):
     # Ctrl+grave
     print session.process_key_event(keysyms.grave, modifier.CONTROL_MASK)
@@ -46,6 +64,11 @@ def test(session):
     # input
     #feed(session, "pinyin-shuru'fa' ")
     feed(session, 'jiong ')
+    # the page count covers all candidates, not only those generated so far
+    feed(session, 'ji{Page_Down}{Escape}')
+    # paste
+    feed_batch(session, 'nihao ')
+    feed_batch(session, 'zhongguo')
 
 def main():
     sid = weasel.service.create_session()
@@ -8,11 +8,13 @@ __all__ = (
     "service",
 )
 
+import heapq
 import logging
 import logging.config
 import os
 import time
 import threading
+from collections import OrderedDict
 
 logfile = os.path.join(os.path.dirname(__file__), "logging.conf")
 
@@ -22,6 +24,7 @@ logger = logging.getLogger("weasel")
 import ibus
 from core import *
 from engine import *
+from processor import Switcher
 import storage
 
 
@@ -63,14 +66,17 @@ class WeaselSession:
         logger.info("init weasel session: %s", params)
         self.__page_size = storage.DB.read_setting(u'Option/PageSize') or 5
         self.__lookup_table = ibus.LookupTable(self.__page_size)
+        self.__candidates = []
+        # 前端的當前狀態；引擎只推送有變化的部份，回應消息中仍須給出完整的ctx
+        self.__preedit = None
+        self.__aux = None
+        self.__cand = None
         self.__clear()
         self.__backend = Engine(self, params)
 
     def __clear(self):
         self.__commit = None
-        self.__preedit = None
-        self.__aux = None
-        self.__cand = None
+        self.__updated = False
 
     def process_key_event(self, keycode, mask):
         '''處理鍵盤事件'''
@@ -80,6 +86,22 @@ class WeaselSession:
         taken = self.__backend.process_key_event(KeyEvent(keycode, mask))
         return taken
 
+    def process_key_events(self, events):
+        '''批量處理鍵盤事件
+
+        events為 (keycode, mask) 序列，如粘貼的文字；上屏文字依次累積，回應消息只含最後的狀態
+        返回各事件是否已處理
+
+        '''
+        logger.debug("process_key_events: %d events" % len(events))
+        self.__clear()
+        return self.__backend.process_key_events([KeyEvent(keycode, mask) for keycode, mask in events])
+
+    def get_schema_id(self):
+        '''當前方案的標識；無可用的方案時為None'''
+        schema = self.__backend.schema
+        return schema.schema_id if schema else None
+
     def get_response(self):
         '''生成回應消息'''
         actions = set()
@@ -87,12 +109,13 @@ class WeaselSession:
         if self.__commit:
             actions.add(u'commit')
             msg.append(u'commit=%s\n' % u''.join(self.__commit)) 
-        if self.__preedit:
-            add_text(actions, msg, u'preedit', self.__preedit)
-        if self.__aux:
-            add_text(actions, msg, u'aux', self.__aux)
-        if self.__cand:
-            add_cand(actions, msg, self.__cand)
+        if self.__updated:
+            if self.__preedit:
+                add_text(actions, msg, u'preedit', self.__preedit)
+            if self.__aux:
+                add_text(actions, msg, u'aux', self.__aux)
+            if self.__cand:
+                add_cand(actions, msg, self.__cand)
         #self.__clear()
         if not actions:
             return u'action=noop\n.\n'
@@ -127,6 +150,7 @@ class WeaselSession:
         #self.__preedit = (s, attrs)
         cursor = (start, end) if start < end else None
         self.__preedit = (s, None, cursor)
+        self.__updated = True
 
     def update_aux(self, s, start=0, end=0):
         '''更新輔助串
@@ -140,27 +164,39 @@ class WeaselSession:
             logger.debug(u'aux: [%s]' % s)
         cursor = (start, end) if start < end else None
         self.__aux = (s, None, cursor)
+        self.__updated = True
 
     def update_candidates(self, candidates):
         '''更新候選列表'''
         self.__lookup_table.clean()
         self.__lookup_table.show_cursor(False)
+        self.__candidates = candidates
         if not candidates:
             self.__cand = (0, 0, 0, [])
+            self.__updated = True
         else:
-            for c in candidates:
-                self.__lookup_table.append_candidate(ibus.Text(c[0]))
             self.__update_page()
 
+    def __fetch_candidates(self):
+        '''候選按需生成；向LookupTable補足到下一頁末尾'''
+        n = self.__lookup_table.get_number_of_candidates()
+        p = self.__lookup_table.get_page_size()
+        end = (self.__lookup_table.get_cursor_pos() / p + 2) * p
+        for c in self.__candidates[n:end]:
+            self.__lookup_table.append_candidate(ibus.Text(c[0]))
+
     def __update_page(self):
+        self.__fetch_candidates()
         candidates = self.__lookup_table.get_candidates_in_current_page()
-        n = self.__lookup_table.get_number_of_candidates()
+        # 總頁數按全部候選計算，而非LookupTable中已生成的部份
+        n = len(self.__candidates)
         c = self.__lookup_table.get_cursor_pos()
         p = self.__lookup_table.get_page_size()
         current_page = c / p
         total_pages = (n + p - 1) / p
         cands = [(x.get_text(), None) for x in candidates]
         self.__cand = (current_page, total_pages, c % p, cands)
+        self.__updated = True
             
     def page_up(self):
         if self.__lookup_table.page_up():
@@ -209,51 +245,143 @@ class WeaselService:
 
     管理一組會話
     每個會話對象持有一個算法引擎實例，並響應一個IME前端的輸入請求
+    按最近選用的方案，在後台線程中預先創建若干會話，開啟輸入法時直接取用
 
     '''
     
     SESSION_EXPIRE_TIME = 3 * 60  # 3 min.
+    # 每個方案預建的會話數目，及保留預建會話的方案數目
+    POOL_SIZE = 2
+    POOL_SCHEMAS = 3
 
     def __init__(self):
         self.__sessions = dict()
+        # 過期時刻的最小堆 [(expire_time, sid, session)]，每個會話一項
+        # 會話活動時只更新其last_active_time，到期檢查時再按實際的過期時刻重新入堆
+        self.__expiry = []
         self.__timer = None
+        # 會話表可能同時為前端的調用和過期檢查的定時器線程所用
+        self.__lock = threading.RLock()
+        # schema_id => [WeaselSession]，最近補充過的方案在後
+        self.__pool = OrderedDict()
+        self.__pool_lock = threading.Lock()
+        self.__filler = None
 
     def cleanup(self):
         '''清除所有會話'''
-        logger.info("cleaning up %d remaining sessions." % len(self.__sessions))
-        self.cancel_check()
-        self.__sessions.clear()
+        with self.__lock:
+            logger.info("cleaning up %d remaining sessions." % len(self.__sessions))
+            timer = self.cancel_check()
+            self.__sessions.clear()
+            del self.__expiry[:]
+        # 等待已取消的定時器線程退出；定時器回調須取得會話表的鎖，故在鎖外等待
+        if timer and timer is not threading.current_thread():
+            timer.join()
+        filler = self.__filler
+        if filler:
+            filler.join()
+        with self.__pool_lock:
+            self.__pool.clear()
+
+    def __take_pooled_session(self):
+        '''取用最近選用方案的預建會話；新建的會話默認也用此方案'''
+        schema_list = Switcher.get_schema_list()
+        if not schema_list:
+            return None
+        with self.__pool_lock:
+            sessions = self.__pool.get(schema_list[0][0])
+            if sessions:
+                return sessions.pop()
+        return None
+
+    def __refill_pool(self):
+        '''在後台線程中補足預建的會話'''
+        with self.__pool_lock:
+            if self.__filler:
+                return
+            self.__filler = threading.Thread(target=self.__fill_pool, name='weasel-pool')
+            self.__filler.daemon = True
+        self.__filler.start()
+
+    def __fill_pool(self):
+        try:
+            while True:
+                schema_list = Switcher.get_schema_list()
+                if not schema_list:
+                    break
+                with self.__pool_lock:
+                    if len(self.__pool.get(schema_list[0][0], ())) >= WeaselService.POOL_SIZE:
+                        break
+                # 未指定方案時選用最近選用的方案，選用記錄不受預建會話的影響
+                session = WeaselSession()
+                schema_id = session.get_schema_id()
+                with self.__pool_lock:
+                    sessions = self.__pool.pop(schema_id, [])
+                    sessions.append(session)
+                    del sessions[WeaselService.POOL_SIZE:]
+                    self.__pool[schema_id] = sessions
+                    while len(self.__pool) > WeaselService.POOL_SCHEMAS:
+                        self.__pool.popitem(last=False)
+        except Exception, e:
+            logger.error("fill_pool: error creating session: %s" % e)
+        finally:
+            with self.__pool_lock:
+                self.__filler = None
 
     def schedule_next_check(self):
-        self.cancel_check()
-        self.__timer = threading.Timer(WeaselService.SESSION_EXPIRE_TIME + 10, \
-                                       lambda: self.check_stale_sessions())
-        self.__timer.start()
+        '''按最早的過期時刻設定定時器'''
+        with self.__lock:
+            self.cancel_check()
+            if not self.__expiry:
+                return
+            delay = max(0, self.__expiry[0][0] - time.time())
+            self.__timer = threading.Timer(delay, self.check_stale_sessions)
+            self.__timer.daemon = True
+            self.__timer.start()
 
     def cancel_check(self):
-        if self.__timer:
-            self.__timer.cancel()
-            self.__timer = None
+        '''取消過期檢查；返回被取消的定時器'''
+        with self.__lock:
+            timer = self.__timer
+            if timer:
+                timer.cancel()
+                self.__timer = None
+            return timer
 
     def check_stale_sessions(self):
-        '''檢查過期的回話'''
-        logger.info("check_stale_sessions...")
-        expire_time = time.time() - WeaselService.SESSION_EXPIRE_TIME
-        for sid in self.__sessions.keys():
-            if self.__sessions[sid].last_active_time < expire_time:
+        '''移除過期的會話
+
+        只查看堆頂已到期的項，不必遍歷所有會話
+
+        '''
+        with self.__lock:
+            now = time.time()
+            while self.__expiry and self.__expiry[0][0] <= now:
+                expire_time, sid, session = heapq.heappop(self.__expiry)
+                # 已結束的會話；標識可能已為新會話重用，以對象比較
+                if self.__sessions.get(sid) is not session:
+                    continue
+                expire_time = session.last_active_time + WeaselService.SESSION_EXPIRE_TIME
+                if expire_time > now:
+                    # 期間有過活動，按新的過期時刻重新入堆
+                    heapq.heappush(self.__expiry, (expire_time, sid, session))
+                    continue
                 logger.info("removing stale session #%x." % sid)
-                self.destroy_session(sid)
-        # 還有活動會話，計劃下一次檢查
-        self.__timer = None
-        if self.__sessions:
-            self.schedule_next_check()
+                del self.__sessions[sid]
+            # 等待鎖的期間定時器已被取消或替換，由新的定時器負責下一次檢查
+            if self.__timer and self.__timer is not threading.current_thread():
+                return
+            self.__timer = None
+            # 還有活動會話，計劃下一次檢查
+            if self.__sessions:
+                self.schedule_next_check()
+            else:
+                del self.__expiry[:]
 
     def has_session(self, sid):
         '''檢查指定會話的存在狀態'''
-        if sid in self.__sessions:
-            return True
-        else:
-            return False
+        with self.__lock:
+            return sid in self.__sessions
 
     def get_session(self, sid):
         '''按標識獲取會話對象
@@ -261,12 +389,11 @@ class WeaselService:
         以傳遞按鍵消息等
 
         '''
-        if sid in self.__sessions:
-            session = self.__sessions[sid]
-            session.last_active_time = time.time()
+        with self.__lock:
+            session = self.__sessions.get(sid)
+            if session:
+                session.last_active_time = time.time()
             return session
-        else:
-            return None
 
     def create_session(self):
         '''創建會話
@@ -276,35 +403,42 @@ class WeaselService:
 
         '''
         try:
-            session = WeaselSession()
-            session.last_active_time = time.time()
+            session = self.__take_pooled_session() or WeaselSession()
         except Exception, e:
             logger.error("create_session: error creating session: %s" % e)
             return None
         sid = id(session)
-        self.__sessions[sid] = session
-        logger.info("create_session: session #%x, total %d active sessions." % \
-                    (sid, len(self.__sessions)))
-        # 啟動過期會話檢查
-        if self.__sessions and not self.__timer:
-            self.schedule_next_check()
+        with self.__lock:
+            session.last_active_time = time.time()
+            self.__sessions[sid] = session
+            heapq.heappush(self.__expiry, (session.last_active_time + WeaselService.SESSION_EXPIRE_TIME,
+                                           sid, session))
+            logger.info("create_session: session #%x, total %d active sessions." % \
+                        (sid, len(self.__sessions)))
+            # 啟動過期會話檢查
+            if not self.__timer:
+                self.schedule_next_check()
+        self.__refill_pool()
         return sid
 
     def destroy_session(self, sid):
         '''結束指定的會話
 
         IME前端關閉輸入法時調用
+        堆中的對應項留待到期時跳過
 
         '''
-        if sid not in self.__sessions:
-            logger.warning("destroy_session: invalid session #%x." % sid)
-            return False
-        del self.__sessions[sid]
-        logger.info("destroy_session: session #%x, %d active sessions left." % \
-                    (sid, len(self.__sessions)))
-        # 已經無有會話時，停了過期會話檢查
-        if not self.__sessions and self.__timer:
-            self.cancel_check()
+        with self.__lock:
+            if sid not in self.__sessions:
+                logger.warning("destroy_session: invalid session #%x." % sid)
+                return False
+            del self.__sessions[sid]
+            logger.info("destroy_session: session #%x, %d active sessions left." % \
+                        (sid, len(self.__sessions)))
+            # 已經無有會話時，停了過期會話檢查
+            if not self.__sessions:
+                self.cancel_check()
+                del self.__expiry[:]
         return True
 
 